@@ -0,0 +1,577 @@
+# Copyright (C) 2012 by Vincent Povirk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Benchmarks for the solver. Run with:
+# $ python bench.py <benchmark> [seed]
+
+import mmap
+import multiprocessing
+import operator
+import random
+import sys
+import tempfile
+import time
+
+import boardparser
+import geometry
+import mines
+
+boards = (
+    ('expert', 30, 16, 99),
+    ('4x-expert', 60, 32, 396),
+)
+
+def random_board(width, height, total, rand, reveal=0.5):
+    """Returns the spaces, known values and informations of a random board in
+    which each clear space has been revealed with probability reveal."""
+    spaces = [(x, y) for y in range(height) for x in range(width)]
+    mine_spaces = frozenset(rand.sample(spaces, total))
+
+    known_values = []
+    informations = []
+    for (x, y) in spaces:
+        if (x, y) in mine_spaces or rand.random() >= reveal:
+            continue
+        bordering_spaces = frozenset((xs, ys) for xs in range(max(x-1, 0), min(x+2, width))
+            for ys in range(max(y-1, 0), min(y+2, height)))
+        known_values.append(((x, y), 0))
+        informations.append(mines.Information(bordering_spaces, len(bordering_spaces & mine_spaces)))
+    informations.append(mines.Information(frozenset(spaces), total))
+
+    return spaces, known_values, informations
+
+def time_solve(engine, spaces, known_values, informations, np):
+    start = time.time()
+    solver = mines.Solver(spaces, engine=engine)
+    for space, value in known_values:
+        solver.add_known_value(space, value)
+    for information in informations:
+        solver.add_information(information)
+    solver.solve(np=np)
+    return time.time() - start, solver
+
+def bench_engines(seed):
+    for name, width, height, total in boards:
+        rand = random.Random(seed)
+        board = random_board(width, height, total, rand)
+        for np in (False, True):
+            results = []
+            for engine in ('frozenset', 'bitset'):
+                elapsed, solver = time_solve(engine, *board, np=np)
+                results.append((engine, elapsed, solver))
+                print '%-10s np=%-5s %-9s %8.3fs' % (name, np, engine, elapsed)
+            # Without np, what is found depends on the order the informations
+            # happen to be processed in, so only a full solve is compared.
+            if np and results[0][2].solved_spaces != results[1][2].solved_spaces:
+                print '%-10s np=%-5s engines disagree!' % (name, np)
+
+def random_frontier(size, rand, density=0.45):
+    """Returns the spaces, known values and informations of a strip three
+    spaces high, with a number revealed in every other space of the middle
+    row, so that there are about size unknown spaces next to the numbers."""
+    length = size * 2 // 5
+    spaces = [(x, y) for y in range(3) for x in range(length)]
+    revealed_spaces = frozenset((x, 1) for x in range(1, length, 2))
+    mine_spaces = frozenset(space for space in spaces
+        if space not in revealed_spaces and rand.random() < density)
+
+    known_values = []
+    informations = []
+    for (x, y) in sorted(revealed_spaces):
+        bordering_spaces = frozenset((xs, ys) for xs in range(max(x-1, 0), min(x+2, length))
+            for ys in range(3))
+        known_values.append(((x, y), 0))
+        informations.append(mines.Information(bordering_spaces, len(bordering_spaces & mine_spaces)))
+
+    return spaces, known_values, informations
+
+def bench_counters(seed):
+    for size in (30, 60, 120):
+        rand = random.Random(seed)
+        spaces, known_values, informations = random_frontier(size, rand)
+        results = []
+        for counter in ('split', 'dp'):
+            solver = mines.Solver(spaces)
+            solver.counter = counter
+            solver.cluster_probabilities_cache = mines.LRUCache()
+            for space, value in known_values:
+                solver.add_known_value(space, value)
+            for information in informations:
+                solver.add_information(information)
+            solver.solve(np=False)
+            start = time.time()
+            results.append(solver.get_probabilities())
+            print 'frontier %3i %-5s %8.3fs' % (size, counter, time.time() - start)
+        if results[0] != results[1]:
+            print 'frontier %3i counters disagree!' % size
+
+def bench_totals(seed):
+    # Without split_on_total, the larger board takes too long to be useful.
+    for name, width, height, total in boards[:1]:
+        rand = random.Random(seed)
+        spaces, known_values, informations = random_board(width, height, total, rand, reveal=0.2)
+        results = []
+        for split_on_total in (True, False):
+            solver = mines.Solver(spaces)
+            solver.counter = 'dp'
+            solver.split_on_total = split_on_total
+            solver.cluster_probabilities_cache = mines.LRUCache()
+            for space, value in known_values:
+                solver.add_known_value(space, value)
+            for information in informations:
+                solver.add_information(information)
+            solver.solve()
+            start = time.time()
+            results.append(solver.get_probabilities())
+            print '%-10s split_on_total=%-5s %8.3fs' % (name, split_on_total, time.time() - start)
+        if results[0] != results[1]:
+            print '%-10s results disagree!' % name
+
+def bench_processes(seed):
+    processes = multiprocessing.cpu_count()
+    for name, width, height, total in boards:
+        rand = random.Random(seed)
+        spaces, known_values, informations = random_board(width, height, total, rand)
+        results = []
+        for solver_processes in (0, processes):
+            start = time.time()
+            solver = mines.Solver(spaces)
+            solver.processes = solver_processes
+            solver.cluster_probabilities_cache = mines.LRUCache()
+            solver.clusters_checked_cache = mines.LRUCache()
+            for space, value in known_values:
+                solver.add_known_value(space, value)
+            for information in informations:
+                solver.add_information(information)
+            solver.solve()
+            results.append((solver.solved_spaces, solver.get_probabilities()))
+            print '%-10s processes=%-3i %8.3fs' % (name, solver_processes, time.time() - start)
+        if results[0] != results[1]:
+            print '%-10s results disagree!' % name
+
+def random_layout(num_spaces, num_informations, rand):
+    """Returns informations about random groups of spaces, like the 'auto1'
+    layout in test.py but larger."""
+    mine_spaces = frozenset(space for space in range(num_spaces) if rand.random() < 0.4)
+    informations = []
+    for i in range(num_informations):
+        spaces = frozenset(rand.sample(range(num_spaces), rand.randint(4, 10)))
+        informations.append(mines.Information(spaces, len(spaces & mine_spaces)))
+    return informations
+
+def bench_copies(seed):
+    for num_spaces, num_informations in ((100, 40), (120, 48), (160, 64)):
+        rand = random.Random(seed)
+        informations = random_layout(num_spaces, num_informations, rand)
+        solver = mines.Solver(range(num_spaces))
+        for information in informations:
+            solver.add_information(information)
+        solver.solve(np=False)
+        start = time.time()
+        for cluster in solver.get_clusters():
+            if len(cluster) > 2:
+                mines.Solver.find_cluster_contradiction(cluster)
+        print 'layout %3i/%-3i %8.3fs' % (num_spaces, num_informations, time.time() - start)
+
+    # copies of a whole board that only change a little
+    for name, width, height, total in boards:
+        rand = random.Random(seed)
+        spaces, known_values, informations = random_board(width, height, total, rand)
+        solver = mines.Solver(spaces)
+        for space, value in known_values:
+            solver.add_known_value(space, value)
+        for information in informations:
+            solver.add_information(information)
+        solver.solve(np=False)
+        unknown_spaces = sorted(space for space in spaces if space not in solver.solved_spaces)
+        start = time.time()
+        for space in unknown_spaces:
+            new_solver = solver.copy()
+            new_solver.add_known_value(space, 0)
+            try:
+                new_solver.solve(np=False)
+            except mines.UnsolveableException:
+                pass
+        print '%-10s %4i copies %8.3fs' % (name, len(unknown_spaces), time.time() - start)
+
+def bench_grid(seed):
+    for name, width, height, total in boards:
+        rand = random.Random(seed)
+        spaces, known_values, informations = random_board(width, height, total, rand)
+        mine_spaces = frozenset(rand.sample(spaces, total))
+        cells = []
+        for (x, y) in spaces:
+            if (x, y) in mine_spaces:
+                cells.append('-')
+            elif rand.random() < 0.5:
+                cells.append(str(sum(1 for xs in range(x-1, x+2) for ys in range(y-1, y+2)
+                    if (xs, ys) in mine_spaces)))
+            else:
+                cells.append('-')
+        cells = ''.join(cells)
+
+        start = time.time()
+        for i in range(20):
+            solver = mines.Solver(spaces)
+            for (x, y), cell in zip(spaces, cells):
+                if cell.isdigit():
+                    solver.add_known_value((x, y), 0)
+                    solver.add_information(mines.Information(frozenset((xs, ys)
+                        for xs in range(max(x-1, 0), min(x+2, width))
+                        for ys in range(max(y-1, 0), min(y+2, height))), int(cell)))
+            solver.add_information(mines.Information(frozenset(spaces), total))
+            solver.solve(np=False)
+        print '%-10s per space %8.3fs' % (name, (time.time() - start) / 20)
+
+        for numpy_grid in ((False, True) if mines.numpy is not None else (False,)):
+            start = time.time()
+            for i in range(20):
+                solver = mines.Solver(spaces)
+                solver.numpy_grid = numpy_grid
+                solver.add_grid(width, height, cells, total)
+                solver.solve(np=False)
+            print '%-10s add_grid numpy=%-5s %8.3fs' % (name, numpy_grid, (time.time() - start) / 20)
+
+def bench_floats(seed):
+    # many separate clusters, so that the total count gets very large
+    for num_clusters in (100, 300, 1000):
+        rand = random.Random(seed)
+        solver = mines.Solver(range(num_clusters * 20))
+        for i in range(num_clusters):
+            spaces = frozenset(range(i * 20, i * 20 + 20))
+            solver.add_information(mines.Information(spaces, rand.randint(1, 19)))
+        solver.solve()
+        # count the clusters once, so that only combining them is timed
+        probabilities, arrangements = solver.get_probabilities()
+
+        start = time.time()
+        solver.get_probabilities()
+        print '%4i clusters %4i digits exact %8.4fs' % (num_clusters, len(str(arrangements)), time.time() - start)
+
+        start = time.time()
+        float_probabilities, log_arrangements = solver.get_float_probabilities()
+        print '%4i clusters %4i digits float %8.4fs' % (num_clusters, len(str(arrangements)), time.time() - start)
+        for space in probabilities:
+            if abs(float_probabilities[space] - operator.truediv(probabilities[space], arrangements)) > 1e-9:
+                print '%4i clusters results disagree!' % num_clusters
+                break
+
+def bench_queries(seed):
+    for name, width, height, total in boards:
+        rand = random.Random(seed)
+        spaces, known_values, informations = random_board(width, height, total, rand)
+
+        def new_solver():
+            solver = mines.Solver(spaces)
+            solver.cluster_probabilities_cache = mines.LRUCache()
+            for space, value in known_values:
+                solver.add_known_value(space, value)
+            # leave out the total, as a hint under the mouse cursor would not need it
+            for information in informations[:-1]:
+                solver.add_information(information)
+            solver.solve()
+            return solver
+
+        solver = new_solver()
+        start = time.time()
+        solver.get_probabilities()
+        print '%-10s all spaces %10.6fs' % (name, time.time() - start)
+
+        solver = new_solver()
+        space = rand.choice([space for space in spaces
+            if space not in solver.solved_spaces and solver.get_informations_for_space(space)])
+        start = time.time()
+        solver.get_space_probabilities([space])
+        print '%-10s one space  %10.6fs' % (name, time.time() - start)
+
+        start = time.time()
+        for i in range(100):
+            solver.get_space_probabilities([space])
+        print '%-10s same space %10.6fs' % (name, (time.time() - start) / 100)
+
+def bench_samples(seed):
+    for name, width, height, total in boards:
+        rand = random.Random(seed)
+        spaces, known_values, informations = random_board(width, height, total, rand)
+        solver = mines.Solver(spaces)
+        for space, value in known_values:
+            solver.add_known_value(space, value)
+        for information in informations:
+            solver.add_information(information)
+        solver.solve()
+
+        start = time.time()
+        solver.get_possibility(rand)
+        print '%-10s first sample %8.4fs' % (name, time.time() - start)
+
+        start = time.time()
+        possibilities = solver.get_possibilities(100, rand)
+        print '%-10s 100 samples  %8.4fs' % (name, time.time() - start)
+
+        # the same board, with the total given when sampling instead
+        solver = mines.Solver(spaces)
+        for space, value in known_values:
+            solver.add_known_value(space, value)
+        for information in informations[:-1]:
+            solver.add_information(information)
+        solver.solve()
+
+        start = time.time()
+        possibilities.extend(solver.get_possibilities(100, rand, total))
+        print '%-10s 100 samples with total=%i %8.4fs' % (name, total, time.time() - start)
+
+        for possibility in possibilities:
+            if len(possibility) != len(spaces) or sum(possibility.itervalues()) != total:
+                print '%-10s wrong number of mines!' % name
+                break
+
+def bench_estimate(seed):
+    name, width, height, total = boards[0]
+    rand = random.Random(seed)
+    spaces, known_values, informations = random_board(width, height, total, rand, 0.3)
+    solver = mines.Solver(spaces)
+    solver.counter = 'dp'
+    for space, value in known_values:
+        solver.add_known_value(space, value)
+    for information in informations:
+        solver.add_information(information)
+    solver.solve()
+
+    start = time.time()
+    exact, log_total = solver.get_float_probabilities()
+    print '%-10s exact    %8.4fs' % (name, time.time() - start)
+
+    for time_limit in (0.5, 2.0, 8.0):
+        start = time.time()
+        estimate = solver.estimate_probabilities(time_limit, rand=rand)
+        elapsed = time.time() - start
+        differences = [abs(estimate.probabilities[space] - probability)
+            for space, probability in exact.iteritems()]
+        outside = sum(1 for space, probability in exact.iteritems()
+            if abs(estimate.probabilities[space] - probability) > estimate.errors[space])
+        print '%-10s estimate %8.4fs %7i steps r_hat %6.3f max difference %.3f, %i/%i outside interval' % (
+            name, elapsed, estimate.steps, estimate.r_hat, max(differences), outside, len(exact))
+
+def bench_geometry(seed):
+    for width, height in ((100, 100), (1000, 1000)):
+        spaces = frozenset((x, y) for y in range(height) for x in range(width))
+
+        start = time.time()
+        for space in spaces:
+            x, y = space
+            frozenset(spaces.intersection((x+i, y+j) for i in range(-1, 2) for j in range(-1, 2)))
+        print '%ix%i sets for each space %8.3fs' % (width, height, time.time() - start)
+
+        # each neighbourhood is worked out the first time it's asked for
+        rect = geometry.rect(width, height)
+        start = time.time()
+        for space in spaces:
+            rect.get_neighbourhood(space)
+        print '%ix%i geometry first      %8.3fs' % (width, height, time.time() - start)
+
+        start = time.time()
+        for space in spaces:
+            rect.get_neighbourhood(space)
+        print '%ix%i geometry lookups    %8.3fs' % (width, height, time.time() - start)
+
+def bench_minemaps(seed):
+    rand = random.Random(seed)
+    width, height = 100, 100
+    minemap = mines.RectMap(width, height)
+    count = 100
+
+    for name, randomize in (
+        ('randomize_p per space', lambda: mines.MineMap.randomize_p(minemap, rand)),
+        ('randomize_p', lambda: minemap.randomize_p(rand)),
+        ('randomize_p(0.2)', lambda: minemap.randomize_p(rand, 0.2)),
+        ('randomize_count per space', lambda: mines.MineMap.randomize_count(minemap, rand, 2000)),
+        ('randomize_count', lambda: minemap.randomize_count(rand, 2000)),
+        ):
+        start = time.time()
+        for i in range(count):
+            randomize()
+        print '%ix%i %-26s %8.5fs' % (width, height, name, (time.time() - start) / count)
+
+    start = time.time()
+    for i in range(count):
+        [sum(minemap[s] for s in minemap.get_bordering_spaces(space)) for space in minemap.geometry]
+    print '%ix%i %-26s %8.5fs' % (width, height, 'sums per space', (time.time() - start) / count)
+
+    numpy = mines.numpy
+    mines.numpy = None
+    start = time.time()
+    for i in range(count):
+        minemap.get_neighbour_sums()
+    print '%ix%i %-26s %8.5fs' % (width, height, 'get_neighbour_sums', (time.time() - start) / count)
+    mines.numpy = numpy
+
+    if numpy is not None:
+        start = time.time()
+        for i in range(count):
+            minemap.get_neighbour_sums()
+        print '%ix%i %-26s %8.5fs' % (width, height, 'get_neighbour_sums numpy', (time.time() - start) / count)
+
+def make_solveable_by_copying(puzzle, rand):
+    # how PicmaPuzzle.make_solveable used to try each clue
+    solver = puzzle.create_solver()
+    solver.solve()
+    spaces_left_to_add = list(set(puzzle.minemap.spaces))
+    rand.shuffle(spaces_left_to_add)
+    while len(puzzle.minemap.spaces) != len(solver.solved_spaces):
+        space = spaces_left_to_add.pop()
+        clue = puzzle.get_clue(space)
+        new_solver = solver.copy()
+        new_solver.add_information(clue)
+        new_solver.solve()
+        if new_solver.solved_spaces != solver.solved_spaces or \
+            new_solver.information != solver.information:
+            puzzle.known_spaces[space] = clue.count
+            solver = new_solver
+
+def bench_picma(seed):
+    processes = multiprocessing.cpu_count()
+    for size in (10, 15):
+        for name in ('copies', 'checkpoints', '%i processes' % processes):
+            if name.endswith('processes') and processes == 1:
+                continue
+            # start each from empty caches, or the later ones would look faster
+            mines.global_clusters_checked.clear()
+            mines.global_cluster_probabilities.clear()
+            rand = random.Random(seed)
+            rectmap = mines.RectMap(size, size)
+            rectmap.randomize_p(rand)
+            puzzle = mines.PicmaPuzzle(rectmap)
+            start = time.time()
+            if name == 'copies':
+                make_solveable_by_copying(puzzle, rand)
+            else:
+                if name != 'checkpoints':
+                    puzzle.processes = processes
+                puzzle.make_solveable(rand)
+            print '%ix%i %-12s %8.3fs %i clues' % (size, size, name, time.time() - start, len(puzzle.known_spaces))
+
+def trim_by_resolving(puzzle):
+    # how PicmaPuzzle.trim used to check each clue
+    for space, value in puzzle.known_spaces.items():
+        del puzzle.known_spaces[space]
+        solver = puzzle.create_solver()
+        solver.solve()
+        if len(puzzle.minemap.spaces) != len(solver.solved_spaces):
+            puzzle.known_spaces[space] = value
+
+def bench_trim(seed):
+    for size in (10, 15):
+        rand = random.Random(seed)
+        rectmap = mines.RectMap(size, size)
+        rectmap.randomize_p(rand)
+        puzzle = mines.PicmaPuzzle(rectmap)
+        puzzle.make_solveable(rand)
+        known_spaces = puzzle.known_spaces.copy()
+        results = []
+        for name, search_steps in (('re-solving', None), ('2 steps', 2), ('4 steps', 4)):
+            mines.global_clusters_checked.clear()
+            mines.global_cluster_probabilities.clear()
+            puzzle.known_spaces = known_spaces.copy()
+            start = time.time()
+            if search_steps is None:
+                trim_by_resolving(puzzle)
+            else:
+                puzzle.trim_search_steps = search_steps
+                puzzle.trim(rand)
+            print '%ix%i %-12s %8.3fs %i of %i clues' % (size, size, name, time.time() - start,
+                len(puzzle.known_spaces), len(known_spaces))
+            results.append(puzzle.known_spaces)
+        if any(result != results[0] for result in results):
+            print 'trim results disagree!'
+
+def bench_parse(seed):
+    width, height = 1000, 1000
+    rand = random.Random(seed)
+    f = tempfile.TemporaryFile()
+    for y in range(height):
+        f.write(''.join(rand.choice('-012345678m') for x in range(width)))
+        f.write('\n')
+    f.flush()
+
+    # the loop the command-line modes used before boardparser
+    f.seek(0)
+    start = time.time()
+    cells = []
+    while len(cells) < width * height:
+        char = f.read(1)
+        if not char:
+            raise EOFError()
+        if char in '-0123456789m':
+            cells.append(char)
+    expected = ''.join(cells)
+    print '%ix%i read(1)    %8.3fs' % (width, height, time.time() - start)
+
+    f.seek(0)
+    start = time.time()
+    cells = boardparser.BoardReader(f, boardparser.MINES_CELLS).read_board(width, height)
+    print '%ix%i file       %8.3fs' % (width, height, time.time() - start)
+    if cells != expected:
+        print 'file results disagree!'
+
+    start = time.time()
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    cells = boardparser.BoardReader(m, boardparser.MINES_CELLS).read_board(width, height)
+    print '%ix%i mmap       %8.3fs' % (width, height, time.time() - start)
+    if cells != expected:
+        print 'mmap results disagree!'
+    m.close()
+
+    start = time.time()
+    constraints = sum(1 for constraint in boardparser.get_grid_constraints(width, height, cells))
+    print '%ix%i %i constraints %8.3fs' % (width, height, constraints, time.time() - start)
+    f.close()
+
+if __name__ == '__main__':
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    if sys.argv[1] == 'engines':
+        bench_engines(seed)
+    elif sys.argv[1] == 'counters':
+        bench_counters(seed)
+    elif sys.argv[1] == 'totals':
+        bench_totals(seed)
+    elif sys.argv[1] == 'processes':
+        bench_processes(seed)
+    elif sys.argv[1] == 'copies':
+        bench_copies(seed)
+    elif sys.argv[1] == 'grid':
+        bench_grid(seed)
+    elif sys.argv[1] == 'floats':
+        bench_floats(seed)
+    elif sys.argv[1] == 'queries':
+        bench_queries(seed)
+    elif sys.argv[1] == 'samples':
+        bench_samples(seed)
+    elif sys.argv[1] == 'estimate':
+        bench_estimate(seed)
+    elif sys.argv[1] == 'geometry':
+        bench_geometry(seed)
+    elif sys.argv[1] == 'minemaps':
+        bench_minemaps(seed)
+    elif sys.argv[1] == 'picma':
+        bench_picma(seed)
+    elif sys.argv[1] == 'trim':
+        bench_trim(seed)
+    elif sys.argv[1] == 'parse':
+        bench_parse(seed)
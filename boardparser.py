@@ -0,0 +1,87 @@
+# Copyright (C) 2012 by Vincent Povirk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Reads boards typed or stored as text, for the command-line modes of mines.py.
+
+import string
+
+# characters allowed in each kind of board
+MINES_CELLS = '-0123456789mc'
+PICMA_CELLS = '-0123456789'
+PICMA_SOLUTION_CELLS = '01'
+
+DIGIT_VALUES = dict((str(i), i) for i in range(10))
+
+# characters allowed between cells
+SEPARATORS = string.whitespace
+
+class BoardReader(object):
+    """Reads cells from a file, or anything else with a readline method such as
+    an mmap object, a line at a time. Several boards can be read one after
+    another from the same reader."""
+
+    def __init__(self, infile, allowed):
+        self.infile = infile
+        self.allowed = allowed
+        self.buffer = ''
+        # for str.translate, the characters that aren't cells
+        self.not_cells = ''.join(chr(i) for i in range(256) if chr(i) not in allowed)
+        self.valid = allowed + SEPARATORS
+
+    def read_cells(self, count):
+        """Returns the next count cells as a string, skipping separators.
+        Raises ValueError for any other character, or EOFError if the file ends
+        first."""
+        parts = [self.buffer]
+        length = len(self.buffer)
+        while length < count:
+            line = self.infile.readline()
+            if not line:
+                self.buffer = ''
+                raise EOFError()
+            invalid = line.translate(None, self.valid)
+            if invalid:
+                raise ValueError("Unknown cell %r" % (invalid[0],))
+            line = line.translate(None, self.not_cells)
+            parts.append(line)
+            length += len(line)
+        cells = ''.join(parts)
+        self.buffer = cells[count:]
+        return cells[:count]
+
+    def read_board(self, width, height):
+        """Returns the cells of a width by height board, row by row."""
+        return self.read_cells(width * height)
+
+def get_grid_constraints(width, height, cells, include_center=False):
+    """Yields (spaces, count) for each digit in cells, a board given row by row,
+    where spaces is a frozenset of the (x, y) spaces around the digit,
+    including its own space if include_center is set."""
+    columns = [range(max(x-1, 0), min(x+2, width)) for x in xrange(width)]
+    for y in xrange(height):
+        rows = range(max(y-1, 0), min(y+2, height))
+        row = cells[y*width:(y+1)*width]
+        for x, cell in enumerate(row):
+            count = DIGIT_VALUES.get(cell)
+            if count is not None:
+                spaces = [(xs, ys) for ys in rows for xs in columns[x]]
+                if not include_center:
+                    spaces.remove((x, y))
+                yield frozenset(spaces), count
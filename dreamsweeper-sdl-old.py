@@ -26,6 +26,7 @@ random = random.SystemRandom()
 import pygame
 from pygame.locals import *
 
+import geometry
 import mines
 
 mines_image = pygame.image.load('mines.bmp')
@@ -49,7 +50,8 @@ class DreamBoard(object):
         self.count = count
         self.solver = None
         self.values = [UNKNOWN] * (width * height)
-        self.spaces = frozenset((x, y) for x in range(width) for y in range(height))
+        self.geometry = geometry.rect(width, height)
+        self.spaces = frozenset(self.geometry.spaces)
         self.possibility = None
 
     def clear(self):
@@ -65,8 +67,7 @@ class DreamBoard(object):
             if solver.solved_spaces.get((x, y), 0) != 0:
                 raise mines.UnsolveableException()
             solver.add_known_value((x, y), 0)
-            spaces = frozenset(self.spaces.intersection((x+i, y+j) for i in range(-1, 2) for j in range(-1, 2)))
-            solver.add_information(mines.Information(spaces, value))
+            solver.add_information(mines.Information(self.geometry.get_neighbourhood((x, y)), value))
         elif value == MINE:
             if solver.solved_spaces.get((x, y), 1) != 1:
                 raise mines.UnsolveableException()
@@ -210,12 +211,11 @@ class DreamBoard(object):
         for x in range(self.width):
             for y in range(self.height):
                 if self.get_value(x, y) == 0:
-                    for xi in range(max(x-1, 0), min(x+2, self.width)):
-                        for yi in range(max(y-1, 0), min(y+2, self.height)):
-                            if self.get_value(xi, yi) >= 9 and self.get_value(xi, yi) != CLEAR_Q:
-                                #self.reveal_space(xi, yi)
-                                self.set_value(xi, yi, CLEAR_Q)
-                                return True
+                    for xi, yi in self.geometry.get_adjacent_spaces((x, y)):
+                        if self.get_value(xi, yi) >= 9 and self.get_value(xi, yi) != CLEAR_Q:
+                            #self.reveal_space(xi, yi)
+                            self.set_value(xi, yi, CLEAR_Q)
+                            return True
         
         return False
 
@@ -249,7 +249,7 @@ class DreamBoard(object):
     def _hint_score(self, item):
         space, probability = item
         solver = self.get_solver()
-        informations = solver.informations_for_space[space]
+        informations = solver.get_informations_for_space(space)
         return probability, -max(len(i.spaces) for i in informations), -len(informations)
 
     def hint(self):
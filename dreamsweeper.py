@@ -20,6 +20,7 @@
 
 from __future__ import division
 
+import geometry
 import mines
 
 class Board(object):
@@ -57,13 +58,15 @@ class Board(object):
         if self._solver is None:
             solver = mines.Solver(self.spaces)
 
-            if self.mines != -1:
-                solver.add_information(mines.Information(self.spaces, self.mines))
-
+            known_values = {}
+            numbers = {}
             for (space, (value, adjacent)) in self.known_spaces.iteritems():
-                solver.add_known_value(space, value)
+                known_values[space] = value
                 if adjacent != -1:
-                    solver.add_information(mines.Information(frozenset(self.get_adjacent_spaces(space)), adjacent))
+                    numbers[space] = adjacent
+
+            solver.add_board(known_values, numbers, self.get_adjacent_spaces,
+                self.mines if self.mines != -1 else None)
 
             self._solver = solver
 
@@ -130,7 +133,8 @@ class Board(object):
 
 class SquareBoard(Board):
     def __init__(self, width=12, height=12, mines=36):
-        self.spaces = frozenset((x, y) for x in range(width) for y in range(height))
+        self.geometry = geometry.rect(width, height)
+        self.spaces = frozenset(self.geometry.spaces)
         self.width = width
         self.height = height
 
@@ -165,10 +169,4 @@ class SquareBoard(Board):
             return None
 
     def get_adjacent_spaces(self, space):
-        x, y = space
-        min_x = max(0, x-1)
-        max_x = min(self.width-1, x+1)
-        min_y = max(0, y-1)
-        max_y = min(self.height-1, y+1)
-        return frozenset((x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1))
-
+        return self.geometry.get_adjacent_spaces(space)
@@ -0,0 +1,222 @@
+# Copyright (C) 2012 by Vincent Povirk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Board shapes, with the spaces next to each space worked out once per shape.
+
+import itertools
+import weakref
+
+class Geometry(object):
+    """A set of spaces and which spaces are next to each other. The spaces
+    around each space are worked out the first time they're asked for and then
+    kept, so the same frozensets are returned every time, and a large board only
+    holds them for the spaces that have been used.
+
+    spaces is a tuple of the spaces in a fixed order, and index maps each space
+    to its position in it. Both are built the first time they're needed.
+    Subclasses provide get_spaces, which returns the spaces in order, and
+    find_neighbourhood, which returns a frozenset of a space and the spaces
+    next to it, or raises KeyError if the space isn't one of them."""
+
+    def __init__(self):
+        self.neighbourhoods = {}
+        self.adjacent = {}
+        self._spaces = None
+        self._index = None
+        self.adjacent_indices = None
+
+    @property
+    def spaces(self):
+        if self._spaces is None:
+            self._spaces = tuple(self.get_spaces())
+        return self._spaces
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = dict(itertools.izip(self.spaces, itertools.count()))
+        return self._index
+
+    def get_adjacent_spaces(self, space):
+        """Returns a frozenset of the spaces next to space."""
+        result = self.adjacent.get(space)
+        if result is None:
+            result = self.adjacent[space] = self.get_neighbourhood(space).difference((space,))
+        return result
+
+    def get_neighbourhood(self, space):
+        """Returns a frozenset of space and the spaces next to it."""
+        result = self.neighbourhoods.get(space)
+        if result is None:
+            result = self.neighbourhoods[space] = self.find_neighbourhood(space)
+        return result
+
+    def get_adjacent_indices(self):
+        """Returns a tuple with, for each space in order, a sorted tuple of the
+        indices of the spaces next to it. It is built the first time it's
+        needed."""
+        if self.adjacent_indices is None:
+            index = self.index
+            self.adjacent_indices = tuple(
+                tuple(sorted(index[s] for s in self.get_adjacent_spaces(space)))
+                for space in self.spaces)
+        return self.adjacent_indices
+
+    def __len__(self):
+        return len(self.spaces)
+
+    def __iter__(self):
+        return iter(self.spaces)
+
+    def __contains__(self, space):
+        return space in self.index
+
+class Grid(Geometry):
+    """A grid with any number of dimensions, where each space is next to the
+    spaces that differ by at most 1 in every coordinate. Spaces are tuples of
+    coordinates, ordered with the first coordinate changing fastest, so on a
+    2-dimensional grid (x, y) has index x + y * width. If wrap is set, the
+    edges wrap around, giving a torus in 2 dimensions."""
+
+    def __init__(self, shape, wrap=False):
+        Geometry.__init__(self)
+        self.shape = tuple(shape)
+        self.wrap = wrap
+        # for each dimension, the coordinates next to or equal to each coordinate
+        self.nearby = []
+        for size in self.shape:
+            if wrap:
+                self.nearby.append([tuple(sorted(set((c + o) % size for o in (-1, 0, 1)))) for c in xrange(size)])
+            else:
+                self.nearby.append([tuple(xrange(max(c-1, 0), min(c+2, size))) for c in xrange(size)])
+
+    def get_spaces(self):
+        return (space[::-1] for space in itertools.product(*[xrange(size) for size in reversed(self.shape)]))
+
+    def find_neighbourhood(self, space):
+        try:
+            if len(space) != len(self.shape) or min(space) < 0:
+                raise KeyError(space)
+            return frozenset(itertools.product(*[n[c] for (n, c) in itertools.izip(self.nearby, space)]))
+        except (TypeError, IndexError):
+            raise KeyError(space)
+
+    def __len__(self):
+        return reduce(lambda a, b: a * b, self.shape, 1)
+
+    def __contains__(self, space):
+        try:
+            return len(space) == len(self.shape) and \
+                all(0 <= c < size and c == int(c) for (c, size) in itertools.izip(space, self.shape))
+        except (TypeError, ValueError):
+            return False
+
+class HexGrid(Geometry):
+    """A width by height grid of hexagons, in rows with the odd rows shifted
+    half a space to the right. Spaces are (x, y) tuples, ordered like Grid."""
+
+    even_row_offsets = ((0, 0), (-1, 0), (1, 0), (-1, -1), (0, -1), (-1, 1), (0, 1))
+    odd_row_offsets = ((0, 0), (-1, 0), (1, 0), (0, -1), (1, -1), (0, 1), (1, 1))
+
+    def __init__(self, width, height):
+        Geometry.__init__(self)
+        self.width = width
+        self.height = height
+
+    def get_spaces(self):
+        return ((x, y) for y in xrange(self.height) for x in xrange(self.width))
+
+    def find_neighbourhood(self, space):
+        if space not in self:
+            raise KeyError(space)
+        x, y = space
+        offsets = self.odd_row_offsets if y % 2 else self.even_row_offsets
+        return frozenset((x + dx, y + dy) for (dx, dy) in offsets
+            if 0 <= x + dx < self.width and 0 <= y + dy < self.height)
+
+    def __contains__(self, space):
+        try:
+            x, y = space
+            return 0 <= x < self.width and 0 <= y < self.height and x == int(x) and y == int(y)
+        except (TypeError, ValueError):
+            return False
+
+class CubeSurface(Geometry):
+    """The surface of a cube with size by size spaces on each face. Spaces are
+    (x, y, z) tuples where one coordinate is -1 or size, meaning the space is on
+    that face, and the other two are from 0 to size-1. Spaces that touch,
+    including across the edges and corners of the cube, are exactly those that
+    differ by at most 1 in every coordinate."""
+
+    offsets = tuple(itertools.product((-1, 0, 1), repeat=3))
+
+    def __init__(self, size):
+        Geometry.__init__(self)
+        self.size = size
+
+    def get_spaces(self):
+        size = self.size
+        return (space for space in itertools.product(xrange(-1, size+1), repeat=3)
+            if sum(1 for c in space if c in (-1, size)) == 1)
+
+    def find_neighbourhood(self, space):
+        if space not in self:
+            raise KeyError(space)
+        return frozenset(s for s in (tuple(c + o for (c, o) in itertools.izip(space, offset))
+            for offset in self.offsets) if s in self)
+
+    def __contains__(self, space):
+        try:
+            return len(space) == 3 and all(-1 <= c <= self.size for c in space) and \
+                sum(1 for c in space if c in (-1, self.size)) == 1
+        except (TypeError, ValueError):
+            return False
+
+# Held weakly, so that the spaces worked out for a shape are shared while
+# something uses it, and freed once nothing does.
+_geometries = weakref.WeakValueDictionary()
+
+def _get_geometry(cls, *args):
+    key = (cls,) + args
+    result = _geometries.get(key)
+    if result is None:
+        result = _geometries[key] = cls(*args)
+    return result
+
+def rect(width, height):
+    """Returns the shared Grid for a width by height rectangle."""
+    return _get_geometry(Grid, (width, height), False)
+
+def torus(width, height):
+    """Returns the shared Grid for a width by height rectangle whose edges wrap
+    around."""
+    return _get_geometry(Grid, (width, height), True)
+
+def grid(shape, wrap=False):
+    """Returns the shared Grid with the given size in each dimension."""
+    return _get_geometry(Grid, tuple(shape), wrap)
+
+def hexagonal(width, height):
+    """Returns the shared HexGrid for a width by height board."""
+    return _get_geometry(HexGrid, width, height)
+
+def cube(size):
+    """Returns the shared CubeSurface with size by size spaces on each face."""
+    return _get_geometry(CubeSurface, size)
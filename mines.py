@@ -18,9 +18,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import bisect
 import collections
+import heapq
 import itertools
+import json
+import math
+import operator
+import string
 import sys
+import time
+
+import geometry
 
 if sys.platform == 'cli':
     import System
@@ -45,6 +54,16 @@ except ImportError:
     import dummy_thread as thread
     CPU_COUNT = 1
 
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class exception(Exception):
     pass
 
@@ -53,6 +72,18 @@ class UnsolveableException(exception):
 
 Information = collections.namedtuple('Information', ('spaces', 'count'))
 
+# The result of Solver.estimate_probabilities: probabilities and errors map
+# spaces to estimates and the half-widths of their 95% confidence intervals,
+# steps is the number of steps taken by each chain, and r_hat is the largest
+# potential scale reduction factor of any space (close to 1 if the chains
+# agree with each other).
+Estimate = collections.namedtuple('Estimate', ('probabilities', 'errors', 'steps', 'r_hat'))
+
+# Returned by Solver.get_changes: solved maps the spaces solved since a
+# checkpoint to their values, and added and removed are the sets of
+# informations the solver gained and lost.
+Changes = collections.namedtuple('Changes', ('solved', 'added', 'removed'))
+
 def choose(n, k):
     # by Andrew Dalke.
     if 0 <= k <= n:
@@ -66,150 +97,1748 @@ def choose(n, k):
     else:
         return 0
 
-global_clusters_checked = set()
+def multiply_polynomials(a, b, length):
+    """Multiplies two polynomials, given as lists of coefficients starting from
+    the constant term, and returns the first length coefficients."""
+    result = [0] * min(len(a) + len(b) - 1, length)
+    for i, x in enumerate(a[:length]):
+        if x:
+            for j, y in enumerate(b[:length-i]):
+                result[i+j] += x * y
+    return result
+
+def get_suffix_products(polynomials, length):
+    """Returns a list in which item i is the product of polynomials[i:], up to
+    length coefficients."""
+    suffixes = [[1]]
+    for polynomial in reversed(polynomials):
+        suffixes.append(multiply_polynomials(polynomial, suffixes[-1], length))
+    suffixes.reverse()
+    return suffixes
+
+def choose_counts(polynomials, suffixes, count, rand):
+    """Chooses a number for each polynomial so that they add up to count,
+    with probability proportional to the product of the coefficients for
+    those numbers. suffixes is the result of get_suffix_products."""
+    result = []
+    remaining = count
+    for index, polynomial in enumerate(polynomials):
+        suffix = suffixes[index+1]
+        weights = []
+        total = 0
+        for number in range(min(len(polynomial) - 1, remaining) + 1):
+            if remaining - number < len(suffix):
+                total += polynomial[number] * suffix[remaining - number]
+            weights.append(total)
+        number = bisect.bisect_right(weights, rand.randrange(total))
+        result.append(number)
+        remaining -= number
+    return result
+
+def get_information_clusters(informations):
+    """Divides informations into groups connected by shared spaces."""
+    informations_for_space = collections.defaultdict(list)
+    for information in informations:
+        for space in information.spaces:
+            informations_for_space[space].append(information)
+
+    informations_unassigned = set(informations)
+    result = []
+    while informations_unassigned:
+        information = informations_unassigned.pop()
+        cluster = set((information,))
+        unchecked_informations = [information]
+        while unchecked_informations:
+            information = unchecked_informations.pop()
+            for space in information.spaces:
+                for other_information in informations_for_space[space]:
+                    if other_information in informations_unassigned:
+                        informations_unassigned.remove(other_information)
+                        cluster.add(other_information)
+                        unchecked_informations.append(other_information)
+        result.append(frozenset(cluster))
+    return result
+
+def neighbourhood_sum(array):
+    """Returns a NumPy array of the sum of each element of a 2-dimensional
+    array and the up to 8 elements around it."""
+    height, width = array.shape
+    padded = numpy.zeros((height+2, width+2), dtype=numpy.int16)
+    padded[1:-1, 1:-1] = array
+    result = numpy.zeros((height, width), dtype=numpy.int16)
+    for dy in range(3):
+        for dx in range(3):
+            result += padded[dy:dy+height, dx:dx+width]
+    return result
+
+class ArrangementCounter(object):
+    """Counts the arrangements of mines that satisfy a set of informations.
+
+    The spaces are given as classes of interchangeable spaces: sizes is a
+    sequence of the number of spaces in each class, and informations is a
+    sequence of (count, class indices) pairs, which is the same form as the
+    key returned by Solver.get_canonical_cluster. If tracked is given, the
+    arrangements are also counted by the number of mines in those classes.
+
+    The classes are placed one at a time, in an order chosen to keep the
+    number of partially placed informations small. The state after each step
+    is the number of mines still needed by each of those informations (and the
+    number of tracked mines placed so far), and the number of ways to reach
+    each state is counted with binomial weights."""
+
+    def __init__(self, sizes, informations, tracked=()):
+        self.sizes = sizes
+        self.informations = informations
+        self.tracked = tracked = frozenset(tracked)
+
+        informations_for_class = [[] for size in sizes]
+        for index, (count, classes) in enumerate(informations):
+            for class_index in classes:
+                informations_for_class[class_index].append(index)
+
+        classes_remaining = [len(classes) for (count, classes) in informations]
+        capacity = [sum(sizes[class_index] for class_index in classes) for (count, classes) in informations]
+
+        active = []
+        unplaced = set(range(len(sizes)))
+        self.steps = steps = []
+
+        while unplaced:
+            # place the class that leaves the fewest informations active
+            best_score = None
+            for class_index in unplaced:
+                width = len(set(active).union(informations_for_class[class_index]))
+                for index in informations_for_class[class_index]:
+                    if classes_remaining[index] == 1:
+                        width -= 1
+                if best_score is None or (width, class_index) < best_score:
+                    best_score = (width, class_index)
+            class_index = best_score[1]
+            unplaced.remove(class_index)
+
+            position_before = dict((index, position) for (position, index) in enumerate(active))
+            for index in informations_for_class[class_index]:
+                classes_remaining[index] -= 1
+                capacity[index] -= sizes[class_index]
+            after = [index for index in active if classes_remaining[index]]
+            after.extend(index for index in informations_for_class[class_index]
+                if classes_remaining[index] and index not in position_before)
+            position_after = dict((index, position) for (position, index) in enumerate(after))
+
+            # where each value of the new state comes from: a position in the
+            # old state, or the count of a newly started information
+            sources = [(position_before.get(index), informations[index][0]) for index in after]
+
+            # the informations that this class takes mines from:
+            # (position in the new state, position in the old state, count,
+            # spaces left after this class)
+            changes = [(position_after.get(index), position_before.get(index), informations[index][0], capacity[index])
+                for index in informations_for_class[class_index]]
+
+            steps.append((class_index, sources, changes, class_index in tracked))
+            active = after
+
+        self.layers = None
+        self.final_states = None
+        self.class_possibilities = None
+        self.class_polynomials = None
+        self.sampling_layers = {}
+
+    def count(self):
+        """Counts the arrangements. layers[i] maps each state reachable before
+        step i to (number of ways to reach it, list of (mines, next state))."""
+        if self.layers is not None:
+            return sum(self.final_states.itervalues())
+
+        tracking = bool(self.tracked)
+        self.layers = layers = []
+        states = {(0,) if tracking else (): 1}
+        for class_index, sources, changes, tracked in self.steps:
+            size = self.sizes[class_index]
+            weights = [choose(size, mines) for mines in range(size+1)]
+            layer = {}
+            new_states = collections.defaultdict(int)
+            for state, ways in states.iteritems():
+                lowest = 0
+                highest = size
+                for position_after, position_before, count, capacity in changes:
+                    value = count if position_before is None else state[position_before]
+                    if value - capacity > lowest:
+                        lowest = value - capacity
+                    if value < highest:
+                        highest = value
+                edges = []
+                if lowest <= highest:
+                    base = [count if position_before is None else state[position_before]
+                        for (position_before, count) in sources]
+                    if tracking:
+                        base.append(state[-1])
+                    for mines in range(lowest, highest+1):
+                        new_state = list(base)
+                        for position_after, position_before, count, capacity in changes:
+                            if position_after is not None:
+                                new_state[position_after] -= mines
+                        if tracked:
+                            new_state[-1] += mines
+                        new_state = tuple(new_state)
+                        edges.append((mines, new_state))
+                        new_states[new_state] += ways * weights[mines]
+                layer[state] = (ways, edges)
+            layers.append(layer)
+            states = new_states
+
+        self.final_states = states
+        return sum(states.itervalues())
+
+    def get_polynomial(self):
+        """Returns a list of the number of arrangements with each number of
+        mines in the tracked classes."""
+        self.count()
+        result = []
+        for state, ways in self.final_states.iteritems():
+            tracked_mines = state[-1] if self.tracked else 0
+            if tracked_mines >= len(result):
+                result.extend([0] * (tracked_mines + 1 - len(result)))
+            result[tracked_mines] += ways
+        return result
 
-global_clusters_hits = itertools.count(0)
-global_clusters_misses = itertools.count(0)
-global_clusters_solves = itertools.count(0)
+    def get_class_possibilities(self):
+        """Returns a list with the number of arrangements in which any one space
+        of each class is a mine."""
+        if self.class_possibilities is not None:
+            return self.class_possibilities
+
+        if self.tracked:
+            self.class_possibilities = [sum(polynomial) for polynomial in self.get_class_polynomials()]
+            return self.class_possibilities
+
+        self.count()
+
+        result = [0] * len(self.sizes)
+        ways_to_finish = dict((state, 1) for state in self.final_states)
+        for (class_index, sources, changes, tracked), layer in reversed(zip(self.steps, self.layers)):
+            size = self.sizes[class_index]
+            new_ways_to_finish = {}
+            possibilities = 0
+            for state, (ways, edges) in layer.iteritems():
+                finishes = 0
+                mine_finishes = 0
+                for mines, new_state in edges:
+                    ways_after = ways_to_finish.get(new_state)
+                    if ways_after:
+                        finishes += choose(size, mines) * ways_after
+                        mine_finishes += choose(size-1, mines-1) * ways_after
+                if finishes:
+                    new_ways_to_finish[state] = finishes
+                    possibilities += ways * mine_finishes
+            result[class_index] = possibilities
+            ways_to_finish = new_ways_to_finish
+
+        self.class_possibilities = result
+        return result
 
-global_cluster_probabilities = {}
+    def get_class_polynomials(self):
+        """Like get_class_possibilities, but returns a polynomial for each class,
+        in the same form as get_polynomial."""
+        if self.class_polynomials is not None:
+            return self.class_polynomials
+
+        length = len(self.get_polynomial())
+
+        # The ways to finish from each state are kept as a dictionary of
+        # {number of tracked mines at the end: ways}.
+        result = [None] * len(self.sizes)
+        ways_to_finish = {}
+        for state in self.final_states:
+            ways_to_finish[state] = {state[-1] if self.tracked else 0: 1}
+        for (class_index, sources, changes, tracked), layer in reversed(zip(self.steps, self.layers)):
+            size = self.sizes[class_index]
+            new_ways_to_finish = {}
+            polynomial = [0] * length
+            for state, (ways, edges) in layer.iteritems():
+                finishes = collections.defaultdict(int)
+                for mines, new_state in edges:
+                    ways_after = ways_to_finish.get(new_state)
+                    if ways_after:
+                        weight = choose(size, mines)
+                        mine_weight = choose(size-1, mines-1) * ways
+                        for tracked_mines, ways_after_mines in ways_after.iteritems():
+                            finishes[tracked_mines] += weight * ways_after_mines
+                            polynomial[tracked_mines] += mine_weight * ways_after_mines
+                if finishes:
+                    new_ways_to_finish[state] = finishes
+            result[class_index] = polynomial
+            ways_to_finish = new_ways_to_finish
+
+        self.class_polynomials = result
+        return result
 
-global_probabilities_hits = itertools.count(0)
-global_probabilities_misses = itertools.count(0)
+    def get_sampling_layers(self, tracked_mines=None):
+        """Returns, for each step, a dictionary mapping each state before it
+        that can be finished to (cumulative weights, list of (mines, next
+        state)), where the weights are the number of arrangements that
+        finish through each choice. If tracked_mines is given, only
+        arrangements with that many mines in the tracked classes count."""
+        if tracked_mines in self.sampling_layers:
+            return self.sampling_layers[tracked_mines]
+
+        self.count()
+
+        result = []
+        ways_to_finish = dict((state, 1) for state in self.final_states
+            if tracked_mines is None or state[-1] == tracked_mines)
+        for (class_index, sources, changes, tracked), layer in reversed(zip(self.steps, self.layers)):
+            size = self.sizes[class_index]
+            new_ways_to_finish = {}
+            choices = {}
+            for state, (ways, edges) in layer.iteritems():
+                finishes = 0
+                weights = []
+                state_choices = []
+                for mines, new_state in edges:
+                    ways_after = ways_to_finish.get(new_state)
+                    if ways_after:
+                        finishes += choose(size, mines) * ways_after
+                        weights.append(finishes)
+                        state_choices.append((mines, new_state))
+                if finishes:
+                    new_ways_to_finish[state] = finishes
+                    choices[state] = (weights, state_choices)
+            result.append(choices)
+            ways_to_finish = new_ways_to_finish
+        result.reverse()
+
+        self.sampling_layers[tracked_mines] = result
+        return result
 
-# threading utilities that should probably be elsewhere:
+    def sample(self, rand, tracked_mines=None):
+        """Chooses an arrangement uniformly at random, by following the
+        counted states forward and choosing each step in proportion to the
+        arrangements that finish from there. Returns a list of the number of
+        mines in each class."""
+        layers = self.get_sampling_layers(tracked_mines)
+        result = [0] * len(self.sizes)
+        state = (0,) if self.tracked else ()
+        for (class_index, sources, changes, tracked), choices in zip(self.steps, layers):
+            weights, state_choices = choices[state]
+            index = bisect.bisect_right(weights, rand.randrange(weights[-1]))
+            result[class_index], state = state_choices[index]
+        return result
 
-class Promise(object):
-    def __init__(self, queue):
+def estimate_size(obj):
+    """Roughly estimates the number of bytes used by obj and everything it
+    contains. Objects that are shared are counted each time they are seen."""
+    result = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            result += estimate_size(key) + estimate_size(value)
+    elif isinstance(obj, (tuple, list, set, frozenset)):
+        for item in obj:
+            result += estimate_size(item)
+    return result
+
+# The default for arguments of LRUCache.resize that are left as they are.
+_unchanged = object()
+
+class LRUCache(object):
+    """A mapping that forgets the least recently used entries.
+
+    Entries are discarded once there are more than max_entries of them, or
+    once the sizes of the keys and values (as returned by sizeof) add up to
+    more than max_bytes. Either limit may be None for no limit. The hits,
+    misses and evictions attributes count what happened to lookups and
+    entries since the cache was created or last cleared."""
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=estimate_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
         self.lock = threading.Lock()
-        self.finished = False
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, size = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = value, size
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.max_bytes is not None:
+            size = self.sizeof(key) + self.sizeof(value)
+        else:
+            size = 0
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.bytes -= old_entry[1]
+            self.entries[key] = value, size
+            self.bytes += size
+            self.evict()
+
+    def add(self, key):
+        self.set(key, True)
+
+    def evict(self):
+        entries = self.entries
+        while entries and ((self.max_entries is not None and len(entries) > self.max_entries) or
+                           (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            key, (value, size) = entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def resize(self, max_entries=_unchanged, max_bytes=_unchanged):
+        """Changes the limits. A limit that isn't given is left as it is; pass
+        None to remove it."""
+        with self.lock:
+            if max_entries is _unchanged:
+                max_entries = self.max_entries
+            if max_bytes is _unchanged:
+                max_bytes = self.max_bytes
+            if max_bytes is not None and self.max_bytes is None:
+                self.bytes = 0
+                for key, (value, size) in self.entries.items():
+                    size = self.sizeof(key) + self.sizeof(value)
+                    self.entries[key] = value, size
+                    self.bytes += size
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        return dict(entries=len(self.entries), bytes=self.bytes, hits=self.hits,
+            misses=self.misses, evictions=self.evictions)
+
+    def items(self):
+        """Returns a list of (key, value) pairs, least recently used first."""
+        with self.lock:
+            return [(key, value) for (key, (value, size)) in self.entries.iteritems()]
+
+    def update(self, items):
+        for key, value in items:
+            self.set(key, value)
+
+    def snapshot(self):
+        """Returns a copy of the cache, including its counters."""
+        with self.lock:
+            result = LRUCache(self.max_entries, self.max_bytes, self.sizeof)
+            result.entries = self.entries.copy()
+            result.bytes = self.bytes
+            result.hits = self.hits
+            result.misses = self.misses
+            result.evictions = self.evictions
+            return result
+
+# clusters that solve_cluster could not learn anything from
+global_clusters_checked = LRUCache(max_entries=100000)
+
+global_clusters_solves = itertools.count(0)
+
+# results of get_cluster_probabilities
+global_cluster_probabilities = LRUCache(max_entries=100000, max_bytes=256*1024*1024)
+
+# threading utilities that should probably be elsewhere:
+
+class CancelledException(exception):
+    pass
+
+class Future(object):
+    """The result of a task added to an Executor."""
+
+    def __init__(self, executor, f, args, kwargs):
+        self.executor = executor
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.state = 'pending' # or 'running', 'finished', 'cancelled'
         self.value = None
-        self.queue = queue
-        self.lock.acquire()
+        self.exception = None
+        self.time_added = time.time()
+
+    def done(self):
+        return self.state in ('finished', 'cancelled')
 
-    def set(self, value):
-        self.value = value
-        self.finished = True
-        self.lock.release()
+    def cancel(self):
+        """Stops the task from running if it hasn't started yet. Returns True
+        if the task is cancelled."""
+        return self.executor.cancel(self)
 
     def get(self):
-        if not self.finished:
-            while not self.lock.acquire(False):
-                if not self.queue.run_one(False):
-                    self.lock.acquire()
-                    break
-            self.lock.release()
+        """Returns the result of the task, or raises its exception. While the
+        task is not finished, this thread runs it or other tasks, and only
+        waits once there is nothing left that it can run."""
+        executor = self.executor
+        executor.run_now(self)
+        while not self.done():
+            if not executor.run_one(False):
+                with executor.condition:
+                    while not self.done() and not executor.queue_depth:
+                        executor.condition.wait()
+        if self.state == 'cancelled':
+            raise CancelledException()
+        if self.exception is not None:
+            raise self.exception
         return self.value
 
-class TaskQueue(object):
+class Executor(object):
+    """Runs tasks on a number of worker threads.
+
+    Each worker thread has a deque of tasks, and tasks added by a worker go on
+    its own deque. A worker runs its newest task first, and when its deque is
+    empty, it steals the oldest task of another thread. Threads that aren't
+    workers share one more deque. With no worker threads, tasks are run by
+    whichever thread asks for their result."""
+
     def __init__(self, number_of_threads):
-        self.tasks = []
-        self.task_sem = threading.Semaphore(0)
+        self.condition = threading.Condition(threading.Lock())
+        self.deques = [collections.deque() for i in range(number_of_threads + 1)]
+        self.local = threading.local()
+        self.number_of_threads = number_of_threads
+        self.stopping = False
+        self.reset_stats()
+        self.threads = []
         for i in range(number_of_threads):
-            new_thread = threading.Thread(target=TaskQueue.run_forever, args=(self,))
+            new_thread = threading.Thread(target=Executor.run_forever, args=(self, i))
             new_thread.daemon = True
             new_thread.start()
-        self.number_of_threads = number_of_threads
-
-    def run_task(self, task):
-        f, args, kwargs, promise = task
+            self.threads.append(new_thread)
+
+    def shutdown(self):
+        """Stops the worker threads once they finish their current tasks. Tasks
+        that are still queued can only be run by asking for their results."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for worker_thread in self.threads:
+            worker_thread.join()
+
+    def reset_stats(self):
+        with self.condition:
+            self.queue_depth = 0
+            self.max_queue_depth = 0
+            self.added = 0
+            self.finished = 0
+            self.cancelled = 0
+            self.stolen = 0
+            self.total_latency = 0.0
+            self.total_run_time = 0.0
+
+    def stats(self):
+        """Returns a dictionary of counters. latency is the average time between
+        adding a task and starting it, and run_time the average time to run
+        one."""
+        with self.condition:
+            started = self.finished or 1
+            return dict(threads=self.number_of_threads, queue_depth=self.queue_depth,
+                max_queue_depth=self.max_queue_depth, added=self.added,
+                finished=self.finished, cancelled=self.cancelled, stolen=self.stolen,
+                latency=self.total_latency / started, run_time=self.total_run_time / started)
+
+    def add_task(self, f, args=(), kwargs={}):
+        future = Future(self, f, args, kwargs)
+        with self.condition:
+            future.deque = self.deques[getattr(self.local, 'index', -1)]
+            future.deque.append(future)
+            self.added += 1
+            self.queue_depth += 1
+            if self.queue_depth > self.max_queue_depth:
+                self.max_queue_depth = self.queue_depth
+            self.condition.notify_all()
+        return future
+
+    def claim(self, future):
+        # must be called with the condition held
+        if future.state != 'pending':
+            return False
+        future.state = 'running'
+        self.queue_depth -= 1
+        return True
+
+    def unqueue(self, future):
+        # Must be called with the condition held, on a pending future that was
+        # just claimed or cancelled without being taken from its deque, so
+        # that nothing keeps it alive once it's done. It's usually at one end.
+        future_deque = future.deque
+        if future_deque[-1] is future:
+            future_deque.pop()
+        elif future_deque[0] is future:
+            future_deque.popleft()
+        else:
+            future_deque.remove(future)
+
+    def cancel(self, future):
+        with self.condition:
+            if future.state == 'pending':
+                self.unqueue(future)
+                future.state = 'cancelled'
+                self.queue_depth -= 1
+                self.cancelled += 1
+                self.condition.notify_all()
+            return future.state == 'cancelled'
+
+    def take(self):
+        # must be called with the condition held
+        index = getattr(self.local, 'index', -1) % len(self.deques)
+        own_deque = self.deques[index]
+        while own_deque:
+            future = own_deque.pop()
+            if self.claim(future):
+                return future
+        for i in range(1, len(self.deques)):
+            other_deque = self.deques[(index + i) % len(self.deques)]
+            while other_deque:
+                future = other_deque.popleft()
+                if self.claim(future):
+                    self.stolen += 1
+                    return future
+        return None
+
+    def run(self, future):
+        start = time.time()
         try:
-            promise.set(f(*args, **kwargs))
+            future.value = future.f(*future.args, **future.kwargs)
         except BaseException, e:
-            promise.set(e)
+            future.exception = e
+        end = time.time()
+        with self.condition:
+            future.state = 'finished'
+            self.finished += 1
+            self.total_latency += start - future.time_added
+            self.total_run_time += end - start
+            self.condition.notify_all()
+
+    def run_now(self, future):
+        """Runs future in this thread if no other thread has started it."""
+        with self.condition:
+            claimed = self.claim(future)
+            if claimed:
+                self.unqueue(future)
+        if claimed:
+            self.run(future)
 
     def run_one(self, block=True):
-        if self.task_sem.acquire(block):
-            task = self.tasks.pop(0)
-            self.run_task(task)
-            return True
-        else:
+        with self.condition:
+            future = self.take()
+            while future is None and block and not self.stopping:
+                self.condition.wait()
+                future = self.take()
+        if future is None:
             return False
+        self.run(future)
+        return True
 
-    def run_forever(self):
-        while True:
+    def run_forever(self, index):
+        self.local.index = index
+        while not self.stopping:
             self.run_one()
 
-    def add_task(self, f, args=(), kwargs={}, block=True):
-        promise = Promise(self)
-        self.tasks.append((f, args, kwargs, promise))
-        self.task_sem.release()
-        return promise
+executor = Executor(CPU_COUNT if CPU_COUNT > 1 else 0)
 
-class DummyTaskQueue(TaskQueue):
-    def add_task(self, f, args=(), kwargs={}, block=True):
-        promise = Promise(self)
-        promise.set(f(*args, **kwargs))
-        return promise
+# Unlike threads, worker processes do help on CPython. Clusters are sent to
+# them as frozensets of Information, and the results are merged back in the
+# parent by the caller.
 
-if CPU_COUNT == 1:
-    queue = DummyTaskQueue(0)
-else:
-    queue = TaskQueue(CPU_COUNT)
+process_pools = {}
+
+def get_process_pool(processes):
+    """Returns a multiprocessing pool with the given number of processes, which
+    is created the first time it's needed and then kept for reuse."""
+    pool = process_pools.get(processes)
+    if pool is None:
+        pool = process_pools[processes] = multiprocessing.Pool(processes)
+    return pool
+
+def solve_cluster_task(cluster):
+    return Solver.find_cluster_contradiction(cluster)
+
+def solver_worker_main(connection, cls, spaces, solved_spaces, informations):
+    # Builds a copy of the parent's solver once, then keeps it up to date with
+    # the informations it's sent and tries candidates on it. Replies are
+    # ('ok', result) pairs. If anything raises, ('error', exception) is sent
+    # instead and the worker stops, so the parent raises it rather than
+    # waiting for a reply that never comes.
+    try:
+        solver = cls(spaces)
+        for space, value in solved_spaces.iteritems():
+            solver.add_known_value(space, value)
+        for information in informations:
+            solver.add_information(information)
+        solver.solve()
+        while True:
+            message = connection.recv()
+            if message is None:
+                break
+            kind, informations = message
+            if kind == 'add':
+                for information in informations:
+                    solver.add_information(information)
+                solver.solve()
+            else:
+                connection.send(('ok', [solver.try_information(information) for information in informations]))
+    except Exception, e:
+        connection.send(('error', e))
+    connection.close()
+
+class WorkerSolvers(object):
+    """Copies of a solver in worker processes, for trying many informations
+    against it at once. The copies are made once, so informations added to the
+    solver afterwards must also be passed to add_informations."""
+
+    def __init__(self, solver, processes):
+        solver.solve()
+        args = (type(solver), solver.spaces, solver.solved_spaces, list(solver.information))
+        self.connections = []
+        self.workers = []
+        for i in xrange(processes):
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=solver_worker_main, args=(worker_connection,) + args)
+            worker.daemon = True
+            worker.start()
+            # so that recv raises EOFError if the worker exits
+            worker_connection.close()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    @staticmethod
+    def receive(connection):
+        """Returns the result of a worker's reply, or raises the exception it
+        sent back."""
+        try:
+            kind, value = connection.recv()
+        except EOFError:
+            raise RuntimeError("Solver worker exited")
+        if kind == 'error':
+            raise value
+        return value
+
+    @staticmethod
+    def send(connection, message):
+        try:
+            connection.send(message)
+        except IOError:
+            # the worker has stopped; raise its error if it sent one
+            WorkerSolvers.receive(connection)
+            raise
+
+    def add_informations(self, informations):
+        informations = list(informations)
+        for connection in self.connections:
+            WorkerSolvers.send(connection, ('add', informations))
+
+    def try_informations(self, informations):
+        """Returns a list of the Changes that each of informations would make
+        on its own, as Solver.try_information does."""
+        informations = list(informations)
+        size = -(-len(informations) // len(self.connections))
+        connections = []
+        for connection, i in itertools.izip(self.connections, xrange(0, len(informations), size)):
+            WorkerSolvers.send(connection, ('try', informations[i:i+size]))
+            connections.append(connection)
+        result = []
+        for connection in connections:
+            result.extend(WorkerSolvers.receive(connection))
+        return result
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except IOError:
+                # the worker has already stopped
+                pass
+        for worker in self.workers:
+            worker.join()
+
+# Counting in a worker starts from an empty cache, and the entries made along
+# the way are returned so that the parent can add them to its own.
+
+def get_task_options(counter, split_on_total):
+    options = Solver(())
+    options.cluster_probabilities_cache = LRUCache()
+    options.counter = counter
+    options.split_on_total = split_on_total
+    return options
+
+def cluster_probabilities_task(cluster, counter, split_on_total):
+    options = get_task_options(counter, split_on_total)
+    possibilities, total = Solver.get_cluster_probabilities(cluster, options)
+    return possibilities, total, options.cluster_probabilities_cache.items()
+
+def part_polynomial_task(part, spaces, counter, split_on_total):
+    options = get_task_options(counter, split_on_total)
+    totals, possibilities = Solver.get_part_polynomial(part, spaces, options)
+    return totals, possibilities, options.cluster_probabilities_cache.items()
 
 # actual minesweeper code
 
+class Cluster(object):
+    """A set of informations that are connected by shared spaces.
+
+    Solver keeps these up to date as informations are added and removed.
+    Adding an information merges clusters immediately. Removing one can split
+    a cluster, but that is only checked when the clusters are next needed, and
+    only for the clusters that lost an information.
+
+    Copies of a Solver share their clusters until they change them. owner is
+    the token of the only solver that may change this cluster in place.
+
+    frozen, counts and sampler cache the informations as a frozenset, the
+    result of get_cluster_probabilities for them and a ClusterSampler, and
+    are reset when the cluster changes."""
+
+    __slots__ = ('informations', 'frozen', 'counts', 'sampler', 'owner')
+
+    def __init__(self, informations=(), owner=None):
+        self.informations = set(informations)
+        self.frozen = None
+        self.counts = None
+        self.sampler = None
+        self.owner = owner
+
+    def __len__(self):
+        return len(self.informations)
+
+class ClusterSampler(object):
+    """Draws arrangements of a cluster uniformly at random.
+
+    The arrangements are counted once, with ArrangementCounter, when the
+    sampler is created, and each sample then only walks through the counts.
+    A cluster that get_cluster_probabilities would split on its total is
+    sampled the same way: first the number of mines that each part shares
+    with the total, then each part with that many.
+
+    For sampling with a total number of mines that is not part of the
+    cluster, get_mine_polynomial and sample_with_mines count and sample
+    the cluster by its number of mines."""
+
+    def __init__(self, cluster, options=None):
+        if options is None:
+            options = Solver
+
+        self.cluster = cluster
+        self.single = None
+        self.split = None
+        self.mine_counter = None
+
+        if len(cluster) == 1:
+            for information in cluster:
+                self.single = (list(information.spaces), information.count)
+            return
+
+        if len(cluster) > 2 and options.split_on_total:
+            split = Solver.split_cluster_on_total(cluster)
+            if split is not None:
+                information, parts, private_spaces = split
+                self.count = information.count
+                self.private_spaces = list(private_spaces)
+                self.parts = []
+                polynomials = []
+                for part in parts:
+                    part_spaces = set()
+                    for other_information in part:
+                        part_spaces.update(other_information.spaces)
+                    key, classes = Solver.get_canonical_cluster(part,
+                        information.spaces.intersection(part_spaces))
+                    counter = ArrangementCounter(*key)
+                    self.parts.append((counter, classes))
+                    polynomials.append(counter.get_polynomial())
+                if private_spaces:
+                    polynomials.append([choose(len(private_spaces), i) for i in range(len(private_spaces)+1)])
+                self.polynomials = polynomials
+                self.suffixes = get_suffix_products(polynomials, self.count + 1)
+                self.split = True
+                return
+
+        key, classes = Solver.get_canonical_cluster(cluster)
+        self.counter = ArrangementCounter(*key)
+        self.classes = classes
+        self.counter.count()
+
+    @staticmethod
+    def place_mines(counter, classes, rand, tracked_mines, result):
+        for class_spaces, mines in itertools.izip(classes, counter.sample(rand, tracked_mines)):
+            mine_spaces = rand.sample(class_spaces, mines)
+            for space in class_spaces:
+                result[space] = 0
+            for space in mine_spaces:
+                result[space] = 1
+
+    def sample(self, rand, result=None):
+        """Adds a random arrangement to the dictionary result, or a new one, and
+        returns it."""
+        if result is None:
+            result = {}
+
+        if self.single is not None:
+            spaces, count = self.single
+            for space in spaces:
+                result[space] = 0
+            for space in rand.sample(spaces, count):
+                result[space] = 1
+            return result
+
+        if self.split is None:
+            ClusterSampler.place_mines(self.counter, self.classes, rand, None, result)
+            return result
+
+        counts = choose_counts(self.polynomials, self.suffixes, self.count, rand)
+        for index, mines in enumerate(counts):
+            if index < len(self.parts):
+                counter, classes = self.parts[index]
+                ClusterSampler.place_mines(counter, classes, rand, mines, result)
+            else:
+                for space in self.private_spaces:
+                    result[space] = 0
+                for space in rand.sample(self.private_spaces, mines):
+                    result[space] = 1
+
+        return result
+
+    def get_mine_polynomial(self):
+        """Returns a list of the number of arrangements of the cluster with
+        each number of mines."""
+        if self.mine_counter is None:
+            spaces = set()
+            for information in self.cluster:
+                spaces.update(information.spaces)
+            key, self.mine_classes = Solver.get_canonical_cluster(self.cluster, spaces)
+            self.mine_counter = ArrangementCounter(*key)
+        return self.mine_counter.get_polynomial()
+
+    def sample_with_mines(self, rand, mines, result):
+        """Like sample, but only chooses from the arrangements with the given
+        number of mines."""
+        self.get_mine_polynomial()
+        ClusterSampler.place_mines(self.mine_counter, self.mine_classes, rand, mines, result)
+        return result
+
+class GibbsChain(object):
+    """A Markov chain over the arrangements of mines that fit a set of
+    informations. Each step picks a small block of spaces and gives them an
+    arrangement chosen uniformly from those that agree with the other spaces'
+    values, so in the long run every arrangement is equally likely.
+
+    The number of steps each space has spent as a mine is only added up when
+    its value changes or a snapshot is taken, so a step costs the same however
+    many spaces there are. snapshots is a list of (steps, mine_steps)."""
+
+    def __init__(self, informations_for_space, block_informations, values, max_block_spaces):
+        self.informations_for_space = informations_for_space
+        self.block_informations = block_informations
+        self.values = values
+        self.max_block_spaces = max_block_spaces
+
+        self.steps = 0
+        self.mine_steps = dict.fromkeys(values, 0)
+        # the first step whose state has each space's current value
+        self.changed = dict.fromkeys(values, 1)
+        self.snapshots = [(0, self.mine_steps.copy())]
+
+    def choose_block(self, rand):
+        """Chooses up to max_block_spaces spaces, starting with a random
+        information and adding the spaces of the informations that overlap
+        it, breadth first, so that the block is a connected region.
+
+        Informations with more spaces than that, such as the total number of
+        mines, are not followed, but then the block could only move mines
+        around within itself. So a quarter of the block is kept for random
+        spaces from those informations."""
+        max_block_spaces = self.max_block_spaces
+        max_region_spaces = max_block_spaces - max_block_spaces // 4
+        information = rand.choice(self.block_informations)
+        block = set()
+        large_informations = set()
+        queue = collections.deque((information,))
+        seen = set(queue)
+        while queue and len(block) < max_region_spaces:
+            information = queue.popleft()
+            spaces = list(information.spaces)
+            rand.shuffle(spaces)
+            for space in spaces:
+                if len(block) >= max_region_spaces:
+                    break
+                block.add(space)
+                for other_information in self.informations_for_space[space]:
+                    if other_information in seen:
+                        continue
+                    seen.add(other_information)
+                    if len(other_information.spaces) <= max_block_spaces:
+                        queue.append(other_information)
+                    else:
+                        large_informations.add(other_information)
+
+        for information in large_informations:
+            if len(block) >= max_block_spaces:
+                break
+            for space in rand.sample(information.spaces, min(len(information.spaces), max_block_spaces // 4)):
+                if len(block) >= max_block_spaces:
+                    break
+                block.add(space)
+
+        return block
+
+    def step(self, rand):
+        values = self.values
+        informations_for_space = self.informations_for_space
+
+        # The informations, limited to the block. As the current values fit
+        # them, the mines outside the block leave as many for inside it as
+        # there are now. The block is small, so its spaces are grouped into
+        # classes directly, without looking for a canonical form.
+        block = self.choose_block(rand)
+        informations_in_block = {}
+        class_for_key = {}
+        classes = []
+        for space in block:
+            key = []
+            for information in informations_for_space[space]:
+                index = informations_in_block.get(information)
+                if index is None:
+                    index = informations_in_block[information] = len(informations_in_block)
+                key.append(index)
+            key = frozenset(key)
+            class_index = class_for_key.get(key)
+            if class_index is None:
+                class_index = class_for_key[key] = len(classes)
+                classes.append([])
+            classes[class_index].append(space)
+
+        class_indices = [[] for information in informations_in_block]
+        for key, class_index in class_for_key.iteritems():
+            for index in key:
+                class_indices[index].append(class_index)
+        informations = [(sum(values[space] for class_index in class_indices[index] for space in classes[class_index]),
+                tuple(class_indices[index]))
+            for index in range(len(class_indices))]
+
+        counter = ArrangementCounter([len(class_spaces) for class_spaces in classes], informations)
+        new_values = {}
+        ClusterSampler.place_mines(counter, classes, rand, None, new_values)
+
+        self.steps = steps = self.steps + 1
+        for space, value in new_values.iteritems():
+            old_value = values[space]
+            if value != old_value:
+                if old_value:
+                    self.mine_steps[space] += steps - self.changed[space]
+                self.changed[space] = steps
+                values[space] = value
+
+    def snapshot(self):
+        """Brings mine_steps up to date, and returns (steps, a copy of it)."""
+        next_step = self.steps + 1
+        for space, value in self.values.iteritems():
+            if value:
+                self.mine_steps[space] += next_step - self.changed[space]
+            self.changed[space] = next_step
+        return self.steps, self.mine_steps.copy()
+
 class Solver(object):
-    def __init__(self, spaces):
+    # caches shared by solvers; these may be replaced for a single solver
+    cluster_probabilities_cache = global_cluster_probabilities
+    clusters_checked_cache = global_clusters_checked
+
+    # how get_cluster_probabilities counts arrangements:
+    #  'split' - divide the cluster by the number of mines in an intersection
+    #  'dp' - dynamic programming over classes of interchangeable spaces
+    counter = 'split'
+
+    # If removing the largest information in a cluster (usually the total
+    # number of mines) would split it, count the parts separately by the number
+    # of mines they have in common with it, and combine the counts.
+    split_on_total = True
+
+    # number of worker processes that solve_np and get_probabilities send
+    # clusters to, or 0 to do everything in this process
+    processes = 0
+
+    # clusters with fewer informations than this are always handled in this
+    # process, because sending them to a worker would cost more than it saves
+    min_process_cluster_size = 16
+
+    # whether add_grid uses NumPy, if it's installed, to apply the simple
+    # rules to the whole board before adding it
+    numpy_grid = True
+
+    # attributes that are passed on to copies of a solver
+    options = ('cluster_probabilities_cache', 'clusters_checked_cache', 'counter', 'split_on_total',
+        'processes', 'min_process_cluster_size', 'numpy_grid')
+
+    def __new__(cls, spaces=(), engine=None):
+        if engine is None or engine == 'frozenset':
+            return object.__new__(cls)
+        elif engine == 'bitset':
+            return BitsetSolver(spaces)
+        else:
+            raise ValueError("Unknown solver engine %r" % (engine,))
+
+    def __init__(self, spaces, engine=None):
         self.spaces = frozenset(spaces)
         self.solved_spaces = dict()
         self.information = set()
-        self.informations_for_space = collections.defaultdict(set)
-        self.spaces_to_add = []
+        self.informations_for_space = {}
+        self.clusters = set()
+        self.cluster_for_information = {}
+        self.clusters_to_split = set()
+        # Work waiting for solve: spaces_to_add maps spaces to their values (or
+        # None if they were given two different values), and
+        # informations_to_add is a heap of (number of spaces, sequence number,
+        # information), so that smaller informations are used first.
+        self.spaces_to_add = {}
         self.informations_to_add = []
+        self.pending_informations = set()
+        self.sequence = itertools.count()
+
+        # number of times solve used each rule, for profiling:
+        #  'known' - removed a space with a known value from an information
+        #  'solved' - removed a solved space from a new information
+        #  'subset' - reduced a new information by one it contains
+        #  'superset' - reduced an information by a new one that it contains
+        #  'overlap' - found values from two overlapping informations
+        self.rule_counts = dict.fromkeys(('known', 'solved', 'subset', 'superset', 'overlap'), 0)
+
+        # copy() shares the sets in informations_for_space and the clusters
+        # with the new solver. Each solver copies one of those the first time
+        # it changes it: writable_spaces are the spaces whose sets belong to
+        # this solver alone, and token marks the clusters that do.
+        self.writable_spaces = set()
+        self.token = object()
+
+        # While checkpoint() is in effect, trail is a list of the changes made
+        # since, as (kind, argument) pairs.
+        self.trail = None
 
     def add_information(self, information):
-        if information.count < 0 or information.count > len(information.spaces):
+        num_spaces = len(information.spaces)
+        if information.count < 0 or information.count > num_spaces:
             raise UnsolveableException()
         if information.count == 0:
             for space in information.spaces:
                 self.add_known_value(space, 0)
-        elif information.count == len(information.spaces):
+        elif information.count == num_spaces:
             for space in information.spaces:
                 self.add_known_value(space, 1)
-        else:
-            self.informations_to_add.append(information)
+        elif information not in self.pending_informations:
+            self.pending_informations.add(information)
+            heapq.heappush(self.informations_to_add, (num_spaces, next(self.sequence), information))
+
+    def link_information(self, information):
+        self.information.add(information)
+        self.index_information(information)
+        self.add_information_to_cluster(information)
+        if self.trail is not None:
+            self.trail.append(('link', information))
 
     def remove_information(self, information):
         self.information.remove(information)
+        self.unindex_information(information)
+        self.remove_information_from_cluster(information)
+        if self.trail is not None:
+            self.trail.append(('remove', information))
+
+    def get_writable_cluster(self, cluster):
+        if cluster.owner is self.token:
+            return cluster
+        new_cluster = Cluster(cluster.informations, self.token)
+        new_cluster.frozen = cluster.frozen
+        new_cluster.counts = cluster.counts
+        new_cluster.sampler = cluster.sampler
+        self.clusters.remove(cluster)
+        self.clusters.add(new_cluster)
+        if cluster in self.clusters_to_split:
+            self.clusters_to_split.remove(cluster)
+            self.clusters_to_split.add(new_cluster)
+        cluster_for_information = self.cluster_for_information
+        for information in new_cluster.informations:
+            cluster_for_information[information] = new_cluster
+        return new_cluster
+
+    def index_information(self, information):
+        informations_for_space = self.informations_for_space
+        writable_spaces = self.writable_spaces
+        for space in information.spaces:
+            if space not in writable_spaces:
+                informations_for_space[space] = set(informations_for_space.get(space, ()))
+                writable_spaces.add(space)
+            informations_for_space[space].add(information)
+
+    def unindex_information(self, information):
+        informations_for_space = self.informations_for_space
+        writable_spaces = self.writable_spaces
+        for space in information.spaces:
+            if space not in writable_spaces:
+                informations_for_space[space] = set(informations_for_space[space])
+                writable_spaces.add(space)
+            informations_for_space[space].remove(information)
+
+    def add_information_to_cluster(self, information):
+        cluster_for_information = self.cluster_for_information
+
+        clusters = set()
+        for other_information in self.get_intersecting_informations(information):
+            if other_information in cluster_for_information:
+                clusters.add(cluster_for_information[other_information])
+
+        if clusters:
+            # merge into the largest cluster, so each information is moved
+            # O(log n) times at most
+            cluster = max(clusters, key=len)
+            clusters.remove(cluster)
+            cluster = self.get_writable_cluster(cluster)
+            for other_cluster in clusters:
+                for other_information in other_cluster.informations:
+                    cluster_for_information[other_information] = cluster
+                cluster.informations.update(other_cluster.informations)
+                self.clusters.remove(other_cluster)
+                if other_cluster in self.clusters_to_split:
+                    self.clusters_to_split.remove(other_cluster)
+                    self.clusters_to_split.add(cluster)
+            cluster.frozen = None
+            cluster.counts = None
+            cluster.sampler = None
+        else:
+            cluster = Cluster((), self.token)
+            self.clusters.add(cluster)
+
+        cluster.informations.add(information)
+        cluster_for_information[information] = cluster
+
+    def remove_information_from_cluster(self, information):
+        cluster = self.get_writable_cluster(self.cluster_for_information[information])
+        del self.cluster_for_information[information]
+        cluster.informations.remove(information)
+        cluster.frozen = None
+        cluster.counts = None
+        cluster.sampler = None
+        if cluster.informations:
+            self.clusters_to_split.add(cluster)
+        else:
+            self.clusters.remove(cluster)
+            self.clusters_to_split.discard(cluster)
+
+    def split_cluster(self, cluster):
+        cluster_for_information = self.cluster_for_information
+        if cluster.owner is self.token:
+            informations_unassigned = cluster.informations
+        else:
+            informations_unassigned = set(cluster.informations)
+        self.clusters.remove(cluster)
+
+        while informations_unassigned:
+            information = informations_unassigned.pop()
+            new_cluster = Cluster((information,), self.token)
+            unchecked_informations_in_cluster = [information]
+
+            while unchecked_informations_in_cluster:
+                information = unchecked_informations_in_cluster.pop()
+                for other_information in self.get_intersecting_informations(information):
+                    if other_information in informations_unassigned:
+                        informations_unassigned.remove(other_information)
+                        new_cluster.informations.add(other_information)
+                        unchecked_informations_in_cluster.append(other_information)
+
+            for information in new_cluster.informations:
+                cluster_for_information[information] = new_cluster
+            self.clusters.add(new_cluster)
+
+    def get_informations_for_space(self, space):
+        return self.informations_for_space.get(space, ())
+
+    def get_intersecting_informations(self, information):
+        result = set()
         for space in information.spaces:
-            self.informations_for_space[space].remove(information)
+            result.update(self.informations_for_space.get(space, ()))
+        return result
+
+    def set_solved_value(self, space, value):
+        self.solved_spaces[space] = value
+        if self.trail is not None:
+            self.trail.append(('solve', space))
+
+    def unset_solved_value(self, space):
+        del self.solved_spaces[space]
+
+    def remove_solved_spaces(self, information):
+        solved_spaces = self.solved_spaces
+        for space in information.spaces:
+            if space in solved_spaces:
+                information = Information(
+                    information.spaces.difference((space,)),
+                    information.count - solved_spaces[space])
+        return information
 
     def add_known_value(self, space, value):
-        self.spaces_to_add.append((space, value))
+        if self.spaces_to_add.get(space, value) != value:
+            value = None
+        self.spaces_to_add[space] = value
+
+    def add_board(self, known_values, numbers, get_adjacent_spaces, total=None):
+        """Adds the state of a whole board at once. known_values maps spaces to
+        1 for a mine or 0 for clear, numbers maps revealed spaces to the number
+        of mines adjacent to them (as returned by get_adjacent_spaces), and
+        total is the number of mines in all of the solver's spaces, if known.
+
+        This is the same as calling add_known_value and add_information for
+        each of them, but the known values are taken out of each information
+        before it is added, so solve has much less to do. If get_adjacent_spaces
+        returns a frozenset, as geometry.Geometry does, it is used as it is when
+        none of the spaces in it are known."""
+        for space, count in numbers.iteritems():
+            adjacent = get_adjacent_spaces(space)
+            adjacent_spaces = []
+            for adjacent_space in adjacent:
+                value = known_values.get(adjacent_space)
+                if value is None:
+                    adjacent_spaces.append(adjacent_space)
+                else:
+                    count -= value
+            if isinstance(adjacent, frozenset) and len(adjacent_spaces) == len(adjacent):
+                adjacent_spaces = adjacent
+            self.add_information(Information(frozenset(adjacent_spaces), count))
+
+        for space, value in known_values.iteritems():
+            self.add_known_value(space, value)
+
+        if total is not None:
+            self.add_information(Information(
+                frozenset(space for space in self.spaces if space not in known_values),
+                total - sum(known_values.itervalues())))
+
+    def add_grid(self, width, height, cells, total=None):
+        """Adds the state of a rectangular board, in which the spaces are (x, y)
+        tuples and each space is adjacent to the 8 around it. cells is a string
+        with one character for each space, row by row: '-' for unknown, 'm' for
+        a mine, 'c' for clear, or a digit for a clear space showing the number
+        of adjacent mines. See add_board."""
+        if len(cells) != width * height:
+            raise ValueError("Expected %i cells, got %i" % (width * height, len(cells)))
+
+        if numpy is not None and self.numpy_grid:
+            known_values, numbers = Solver.read_grid_numpy(width, height, cells)
+            self.add_board(known_values, numbers, Solver.get_grid_adjacent_spaces(width, height), total)
+            return
+
+        known_values = {}
+        numbers = {}
+        index = 0
+        for y in xrange(height):
+            for x in xrange(width):
+                cell = cells[index]
+                index += 1
+                if cell == '-':
+                    continue
+                elif cell == 'm':
+                    known_values[x, y] = 1
+                elif cell == 'c':
+                    known_values[x, y] = 0
+                elif cell.isdigit():
+                    known_values[x, y] = 0
+                    numbers[x, y] = int(cell)
+                else:
+                    raise ValueError("Unknown cell %r" % (cell,))
+
+        self.add_board(known_values, numbers, Solver.get_grid_adjacent_spaces(width, height), total)
+
+    @staticmethod
+    def get_grid_adjacent_spaces(width, height):
+        return geometry.rect(width, height).get_adjacent_spaces
+
+    @staticmethod
+    def read_grid_numpy(width, height, cells):
+        """Like the loop in add_grid, but first applies the simple rules to the
+        whole board with NumPy. Returns the known values, and only the numbers
+        that still have unknown spaces next to them. If the simple rules find
+        a contradiction, the board is returned as it is, so that add_board and
+        solve find it as they would without NumPy."""
+        codes = numpy.frombuffer(str(cells), dtype=numpy.uint8).reshape(height, width)
+        is_number = (codes >= ord('0')) & (codes <= ord('9'))
+        is_mine = codes == ord('m')
+        is_clear = is_number | (codes == ord('c'))
+        if not (is_mine | is_clear | (codes == ord('-'))).all():
+            raise ValueError("Unknown cell %r" % (cells[numpy.flatnonzero(~(is_mine | is_clear | (codes == ord('-'))))[0]],))
+
+        values = numpy.where(is_mine, 1, numpy.where(is_clear, 0, -1)).astype(numpy.int8)
+        numbers = numpy.where(is_number, codes.astype(numpy.int16) - ord('0'), -1)
+
+        try:
+            simple_values = values.copy()
+            numbers = Solver.solve_grid_simple(simple_values, numbers)
+            values = simple_values
+        except UnsolveableException:
+            pass
+
+        known_values = {}
+        for y, x in zip(*numpy.nonzero(values >= 0)):
+            known_values[int(x), int(y)] = int(values[y, x])
+        number_values = {}
+        for y, x in zip(*numpy.nonzero(numbers >= 0)):
+            number_values[int(x), int(y)] = int(numbers[y, x])
+        return known_values, number_values
+
+    @staticmethod
+    def solve_grid_simple(values, numbers):
+        """Applies the simple rules to a rectangular board given as NumPy
+        arrays: values holds 1 for a mine, 0 for clear or -1 for unknown, and
+        numbers holds the revealed numbers or -1. A number with all of its mines
+        known makes its other neighbours clear, and a number that needs all of
+        its unknown neighbours makes them mines. values is updated in place
+        until neither rule finds anything more. Returns numbers, with -1 for
+        the numbers that have no unknown neighbours left."""
+        has_number = numbers >= 0
+        while True:
+            unknown = values < 0
+            unknown_count = neighbourhood_sum(unknown)
+            remaining = numbers - neighbourhood_sum(values == 1)
+            if (has_number & ((remaining < 0) | (remaining > unknown_count))).any():
+                raise UnsolveableException()
+
+            active = has_number & (unknown_count > 0)
+            clear = unknown & (neighbourhood_sum(active & (remaining == 0)) > 0)
+            mine = unknown & (neighbourhood_sum(active & (remaining == unknown_count)) > 0)
+            if (clear & mine).any():
+                raise UnsolveableException()
+            if not (clear.any() or mine.any()):
+                return numpy.where(active, numbers, -1)
+
+            values[clear] = 0
+            values[mine] = 1
+
+    def checkpoint(self):
+        """Starts recording changes to the solver, and returns a mark that can
+        be passed to rollback to undo them. Checkpoints can be nested."""
+        if self.trail is None:
+            self.trail = []
+        # Undoing changes to the clusters one at a time would mean merging and
+        # splitting them again, so they are saved instead, and shared with the
+        # saved copy in the same way as copy() shares them.
+        self.trail.append(('checkpoint', (self.spaces_to_add.copy(), list(self.informations_to_add),
+            self.pending_informations.copy(), self.clusters.copy(), self.cluster_for_information.copy(),
+            self.clusters_to_split.copy())))
+        self.token = object()
+        return len(self.trail) - 1
+
+    def rollback(self, mark):
+        """Returns the solver to the state it was in when checkpoint returned
+        mark, even if solve raised UnsolveableException since then."""
+        trail = self.trail
+        while len(trail) > mark:
+            kind, argument = trail.pop()
+            if kind == 'link':
+                self.information.remove(argument)
+                self.unindex_information(argument)
+            elif kind == 'remove':
+                self.information.add(argument)
+                self.index_information(argument)
+            elif kind == 'solve':
+                self.unset_solved_value(argument)
+            else:
+                (spaces_to_add, informations_to_add, pending_informations, self.clusters,
+                    self.cluster_for_information, self.clusters_to_split) = argument
+                self.spaces_to_add = spaces_to_add.copy()
+                self.informations_to_add = list(informations_to_add)
+                self.pending_informations = pending_informations.copy()
+        # the clusters that were just restored may be saved by another checkpoint
+        self.token = object()
+        if not mark:
+            self.trail = None
+
+    def release(self, mark):
+        """Keeps the changes made since checkpoint returned mark. Rolling back
+        to an earlier mark still undoes them."""
+        if not mark:
+            self.trail = None
+
+    def get_changes(self, mark):
+        """Returns a Changes tuple of what solving has done since checkpoint
+        returned mark."""
+        solved = {}
+        added = set()
+        removed = set()
+        for kind, argument in itertools.islice(self.trail, mark + 1, None):
+            if kind == 'solve':
+                solved[argument] = self.solved_spaces[argument]
+            elif kind == 'link':
+                if argument in removed:
+                    removed.remove(argument)
+                else:
+                    added.add(argument)
+            elif kind == 'remove':
+                if argument in added:
+                    added.remove(argument)
+                else:
+                    removed.add(argument)
+        return Changes(solved, added, removed)
+
+    def try_information(self, information):
+        """Returns the Changes that adding information and solving would make,
+        without making them. If the information contradicts what's known, the
+        solver is left as it was and UnsolveableException is raised."""
+        self.solve()
+        mark = self.checkpoint()
+        try:
+            self.add_information(information)
+            self.solve()
+            return self.get_changes(mark)
+        finally:
+            self.rollback(mark)
+
+    def copy_options(self, other):
+        for name in Solver.options:
+            setattr(self, name, getattr(other, name))
 
     def copy(self):
         self.solve(np=False)
-        result = Solver(self.spaces)
+        result = type(self)(self.spaces)
+        result.copy_options(self)
         result.solved_spaces = self.solved_spaces.copy()
         result.information = self.information.copy()
-        for key, value in self.informations_for_space.iteritems():
-            result.informations_for_space[key] = value.copy()
+        result.informations_for_space = self.informations_for_space.copy()
+        result.clusters = self.clusters.copy()
+        result.cluster_for_information = self.cluster_for_information.copy()
+        result.clusters_to_split = self.clusters_to_split.copy()
+        # everything that is now shared has to be copied before it's changed
+        self.writable_spaces = set()
+        self.token = object()
         return result
 
+    def freeze_cluster(self, cluster):
+        return frozenset(cluster.informations)
+
     def get_clusters(self):
-        informations_unassigned = set(self.information)
+        while self.clusters_to_split:
+            self.split_cluster(self.clusters_to_split.pop())
+
         result = set()
+        for cluster in self.clusters:
+            if cluster.frozen is None:
+                cluster.frozen = self.freeze_cluster(cluster)
+            result.add(cluster.frozen)
 
-        while informations_unassigned:
-            information = informations_unassigned.pop()
-            cluster = set((information,))
-            unchecked_spaces_in_cluster = set(information.spaces)
+        return result
+
+    @staticmethod
+    def get_canonical_cluster(cluster, marked_spaces=None):
+        """Relabels a cluster so that isomorphic clusters look the same.
+
+        Spaces that are in exactly the same informations are interchangeable,
+        so they are grouped into classes. The classes and informations are then
+        ordered by their structural role, found by repeatedly refining each
+        one's colour from the colours of its neighbours. Returns (key, classes)
+        where classes is a list of lists of spaces, and key describes the
+        cluster in terms of the positions of the classes in that list.
+
+        Two clusters with the same key are always the same problem, with class
+        i of one corresponding to class i of the other. Ties in the refinement
+        are broken arbitrarily, so isomorphic clusters can occasionally get
+        different keys, which only costs a cache miss.
+
+        If marked_spaces is given, marked and unmarked spaces are never put in
+        the same class, and the key has a third element listing the classes
+        that are marked. Either form of key can be passed to
+        ArrangementCounter."""
+        informations = list(cluster)
+
+        signatures = collections.defaultdict(list)
+        for index, information in enumerate(informations):
+            for space in information.spaces:
+                signatures[space].append(index)
+
+        classes_by_signature = collections.defaultdict(list)
+        for space, signature in signatures.iteritems():
+            marked = marked_spaces is not None and space in marked_spaces
+            classes_by_signature[(marked, tuple(signature))].append(space)
+        class_signatures = classes_by_signature.keys()
+
+        classes_for_information = [[] for information in informations]
+        for class_index, (marked, signature) in enumerate(class_signatures):
+            for index in signature:
+                classes_for_information[index].append(class_index)
+
+        def compress(colours):
+            ranks = dict((colour, rank) for (rank, colour) in enumerate(sorted(set(colours))))
+            return [ranks[colour] for colour in colours]
+
+        class_colours = compress([(len(classes_by_signature[signature]), signature[0]) for signature in class_signatures])
+        information_colours = compress([(information.count, len(information.spaces)) for information in informations])
+        num_colours = 0
+
+        while len(set(class_colours)) + len(set(information_colours)) > num_colours:
+            num_colours = len(set(class_colours)) + len(set(information_colours))
+            class_colours = compress([(class_colours[class_index],
+                    tuple(sorted(information_colours[index] for index in signature)))
+                for (class_index, (marked, signature)) in enumerate(class_signatures)])
+            information_colours = compress([(information_colours[index],
+                    tuple(sorted(class_colours[class_index] for class_index in classes_for_information[index])))
+                for index in range(len(informations))])
+
+        order = sorted(range(len(class_signatures)), key=class_colours.__getitem__)
+        position = [None] * len(order)
+        for new_index, class_index in enumerate(order):
+            position[class_index] = new_index
+
+        classes = [classes_by_signature[class_signatures[class_index]] for class_index in order]
+
+        key = (tuple(len(spaces) for spaces in classes),
+            tuple(sorted((information.count, tuple(sorted(position[class_index] for class_index in classes_for_information[index])))
+                for (index, information) in enumerate(informations))))
+        if marked_spaces is not None:
+            key += (tuple(new_index for (new_index, class_index) in enumerate(order)
+                if class_signatures[class_index][0]),)
+
+        return key, classes
+
+    @staticmethod
+    def split_cluster_on_total(cluster):
+        """Returns (information, parts, private_spaces) if removing the largest
+        information from cluster leaves it in several parts, where parts are
+        the clusters left over and private_spaces are the spaces of
+        information that are in none of them. Otherwise, returns None."""
+        information = max(cluster, key=lambda information: len(information.spaces))
+        parts = get_information_clusters([other_information for other_information in cluster
+            if other_information is not information])
 
-            while unchecked_spaces_in_cluster:
-                space = unchecked_spaces_in_cluster.pop()
-                for information in self.informations_for_space[space]:
-                    if information in informations_unassigned:
-                        informations_unassigned.remove(information)
-                        cluster.add(information)
-                        unchecked_spaces_in_cluster.update(information.spaces)
+        private_spaces = set(information.spaces)
+        for part in parts:
+            for other_information in part:
+                private_spaces.difference_update(other_information.spaces)
 
-            result.add(frozenset(cluster))
+        if len(parts) + (1 if private_spaces else 0) < 2:
+            return None
 
-        return result
+        return information, parts, frozenset(private_spaces)
+
+    @staticmethod
+    def get_part_polynomial(part, spaces, options):
+        """Counts the arrangements of part by the number of mines in spaces.
+        Returns a list of totals and a list of possibilities dictionaries,
+        indexed by that number."""
+        spaces = frozenset(spaces)
+
+        if options.counter == 'dp':
+            # One pass of the counter, tracking the mines in spaces, gives
+            # every number at once.
+            cache = options.cluster_probabilities_cache
+            key, classes = Solver.get_canonical_cluster(part, spaces)
+            result = cache.get(key)
+            if result is None:
+                arrangement_counter = ArrangementCounter(*key)
+                result = (tuple(arrangement_counter.get_polynomial()),
+                    tuple(tuple(polynomial) for polynomial in arrangement_counter.get_class_polynomials()))
+                cache.set(key, result)
+            polynomial, class_polynomials = result
+
+            totals = list(polynomial) + [0] * (len(spaces) + 1 - len(polynomial))
+            possibilities = [{} for total in totals]
+            for class_polynomial, class_spaces in itertools.izip(class_polynomials, classes):
+                for i, possibility in enumerate(class_polynomial):
+                    if possibility:
+                        for space in class_spaces:
+                            possibilities[i][space] = possibility
+            return totals, possibilities
+
+        totals = []
+        possibilities = []
+        for i in range(len(spaces)+1):
+            try:
+                part_possibilities, part_total = Solver.get_cluster_probabilities(
+                    part.union((Information(spaces, i),)), options)
+            except UnsolveableException:
+                part_possibilities, part_total = {}, 0
+            totals.append(part_total)
+            possibilities.append(part_possibilities)
+        return totals, possibilities
+
+    @staticmethod
+    def get_split_cluster_probabilities(information, parts, private_spaces, options):
+        # The number of arrangements of the whole cluster is the coefficient of
+        # x**count in the product of each part's polynomial (number of
+        # arrangements by mines shared with the information) and the binomial
+        # for the private spaces. For each space, replace its own part's
+        # polynomial by the one counting arrangements where it is a mine.
+        count = information.count
+        length = count + 1
+
+        result = {}
+        polynomials = [None] * len(parts)
+        part_possibilities = [None] * len(parts)
+        async_results = []
+        for index, part in enumerate(parts):
+            part_spaces = set()
+            for other_information in part:
+                part_spaces.update(other_information.spaces)
+            for space in part_spaces:
+                result[space] = 0
+            spaces = information.spaces.intersection(part_spaces)
+            if Solver.use_process_pool(part, options):
+                async_results.append((index, get_process_pool(options.processes).apply_async(
+                    part_polynomial_task, (part, spaces, options.counter, options.split_on_total))))
+            else:
+                polynomials[index], part_possibilities[index] = Solver.get_part_polynomial(part, spaces, options)
+
+        for index, async_result in async_results:
+            polynomials[index], part_possibilities[index], cache_entries = async_result.get()
+            options.cluster_probabilities_cache.update(cache_entries)
+
+        if private_spaces:
+            polynomials.append([choose(len(private_spaces), i) for i in range(len(private_spaces)+1)])
+
+        # products of the polynomials before and after each one
+        prefixes = [[1]]
+        for polynomial in polynomials:
+            prefixes.append(multiply_polynomials(prefixes[-1], polynomial, length))
+        suffixes = [[1]]
+        for polynomial in reversed(polynomials):
+            suffixes.append(multiply_polynomials(polynomial, suffixes[-1], length))
+        suffixes.reverse()
+
+        product = prefixes[-1]
+        total = product[count] if count < len(product) else 0
+
+        for index, polynomial in enumerate(polynomials):
+            others = multiply_polynomials(prefixes[index], suffixes[index+1], length)
+            if index < len(parts):
+                for i, possibilities in enumerate(part_possibilities[index]):
+                    if 0 <= count - i < len(others) and others[count-i]:
+                        for space, possibility in possibilities.iteritems():
+                            result[space] += possibility * others[count-i]
+            else:
+                possibility = 0
+                for i in range(1, len(private_spaces)+1):
+                    if 0 <= count - i < len(others):
+                        possibility += choose(len(private_spaces)-1, i-1) * others[count-i]
+                for space in private_spaces:
+                    result[space] = possibility
+
+        return result, total
 
     @staticmethod
-    def get_cluster_probabilities(cluster):
+    def get_cluster_probabilities(cluster, options=None):
+        if options is None:
+            options = Solver
+        cache = options.cluster_probabilities_cache
+
         if len(cluster) == 1:
             cluster_possibilities = {}
             for information in cluster:
@@ -223,18 +1852,35 @@ class Solver(object):
 
             return cluster_possibilities, total
 
-        result = global_cluster_probabilities.get(cluster)
+        if len(cluster) > 2 and options.split_on_total:
+            split = Solver.split_cluster_on_total(cluster)
+            if split is not None:
+                return Solver.get_split_cluster_probabilities(*split, options=options)
+
+        # The cache is keyed on the canonical form of the cluster, and stores
+        # one count per class of interchangeable spaces, so that the same
+        # pattern anywhere on the board can use the same entry.
+        key, classes = Solver.get_canonical_cluster(cluster)
+
+        result = cache.get(key)
+        if result is None and options.counter == 'dp':
+            arrangement_counter = ArrangementCounter(*key)
+            result = tuple(arrangement_counter.get_class_possibilities()), arrangement_counter.count()
+            cache.set(key, result)
         if result is not None:
-            next(global_probabilities_hits)
-            return result
-
-        next(global_probabilities_misses)
+            class_possibilities, total = result
+            possibilities = {}
+            for class_possibility, class_spaces in itertools.izip(class_possibilities, classes):
+                for space in class_spaces:
+                    possibilities[space] = class_possibility
+            return possibilities, total
 
         spaces = set()
         for information in cluster:
             spaces.update(information.spaces)
 
         base_solver = Solver(spaces)
+        base_solver.copy_options(options)
 
         for information in cluster:
             base_solver.add_information(information)
@@ -252,11 +1898,20 @@ class Solver(object):
         total = 0
         possibilities = dict((space, 0) for space in base_solver.spaces)
 
+        # Each task copies base_solver when it runs, so that the copies of the
+        # branches that haven't started yet don't all exist at once. The simple
+        # rules are applied to it first, so that a cluster with no arrangements
+        # raises UnsolveableException here rather than in every branch.
+        base_solver.solve(np=False)
+        copy_lock = threading.Lock()
+        futures = []
         for i in range(max_mines+1):
-            solver = base_solver.copy()
+            futures.append(executor.add_task(Solver.get_probabilities_with_information,
+                args=(base_solver, copy_lock, Information(spaces, i))))
+
+        for future in futures:
             try:
-                solver.add_information(Information(spaces, i))
-                solver_possibilities, solver_total = solver.get_probabilities()
+                solver, (solver_possibilities, solver_total) = future.get()
             except UnsolveableException:
                 continue
             total += solver_total
@@ -266,107 +1921,336 @@ class Solver(object):
                 elif solver.solved_spaces[space]:
                     possibilities[space] += solver_total
 
-        global_cluster_probabilities[cluster] = possibilities, total
+        cache.set(key, (tuple(possibilities[class_spaces[0]] for class_spaces in classes), total))
 
         return possibilities, total
 
-    def get_probabilities(self):
-        self.solve(np=False)
-        clusters = self.get_clusters()
-        result = {}
-        denominator = 1
+    @staticmethod
+    def get_probabilities_with_information(base_solver, copy_lock, information):
+        # copy changes base_solver, so only one thread may copy it at a time
+        with copy_lock:
+            solver = base_solver.copy()
+        solver.add_information(information)
+        return solver, solver.get_probabilities()
 
-        for cluster in clusters:
-            possibilities, total = Solver.get_cluster_probabilities(cluster)
+    @staticmethod
+    def use_process_pool(cluster, options):
+        return (multiprocessing is not None and options.processes > 0 and
+            len(cluster) >= options.min_process_cluster_size)
 
-            for space in result:
-                result[space] *= total
+    def get_cluster_counts(self):
+        """Returns a list of (possibilities, total) for each cluster, as from
+        get_cluster_probabilities."""
+        self.solve(np=False)
+        self.get_clusters()
+
+        cluster_results = []
+        async_results = []
+        for cluster in self.clusters:
+            if cluster.counts is not None:
+                cluster_results.append(cluster.counts)
+            # A cluster that will be split on its total is counted here, so that
+            # its parts can go to different workers.
+            elif Solver.use_process_pool(cluster.frozen, self) and not (
+                    self.split_on_total and Solver.split_cluster_on_total(cluster.frozen)):
+                async_results.append((cluster, get_process_pool(self.processes).apply_async(
+                    cluster_probabilities_task, (cluster.frozen, self.counter, self.split_on_total))))
+            else:
+                cluster.counts = Solver.get_cluster_probabilities(cluster.frozen, self)
+                cluster_results.append(cluster.counts)
+
+        for cluster, async_result in async_results:
+            possibilities, total, cache_entries = async_result.get()
+            self.cluster_probabilities_cache.update(cache_entries)
+            cluster.counts = possibilities, total
+            cluster_results.append(cluster.counts)
+
+        return cluster_results
+
+    def get_space_probabilities(self, spaces):
+        """Returns a dictionary mapping each of the given spaces to the
+        probability that it is a mine, as a float. Only the clusters that
+        contain those spaces are counted, and each cluster keeps its counts
+        until it changes, so asking about the same spaces again is quick.
+        Spaces with known values give 0.0 or 1.0, and spaces that no
+        information is known about are left out. Raises UnsolveableException
+        if a counted cluster has no arrangements."""
+        self.solve(np=False)
+        while self.clusters_to_split:
+            self.split_cluster(self.clusters_to_split.pop())
 
-            for space in possibilities:
-                result[space] = possibilities[space] * denominator
+        result = {}
+        for space in spaces:
+            if space in self.solved_spaces:
+                result[space] = float(self.solved_spaces[space])
+                continue
+            for information in self.get_informations_for_space(space):
+                break
+            else:
+                continue
+            cluster = self.cluster_for_information[information]
+            if cluster.counts is None:
+                if cluster.frozen is None:
+                    cluster.frozen = self.freeze_cluster(cluster)
+                cluster.counts = Solver.get_cluster_probabilities(cluster.frozen, self)
+            possibilities, total = cluster.counts
+            if total == 0:
+                raise UnsolveableException()
+            result[space] = operator.truediv(possibilities.get(space, 0), total)
 
-            denominator *= total
+        return result
 
-        return result, denominator
+    def get_probabilities(self):
+        cluster_results = self.get_cluster_counts()
+        result = {}
 
-    @staticmethod
-    def get_cluster_possibility(cluster, rand):
-        if len(cluster) == 1:
-            result = {}
+        # Each space's count is multiplied by the totals of every other
+        # cluster, which is the product of those before it and those after it.
+        after = [1] * (len(cluster_results) + 1)
+        for i in xrange(len(cluster_results) - 1, -1, -1):
+            after[i] = after[i+1] * cluster_results[i][1]
 
-            for information in cluster:
-                break
+        before = 1
+        for i, (possibilities, total) in enumerate(cluster_results):
+            factor = before * after[i+1]
+            for space in possibilities:
+                result[space] = possibilities[space] * factor
+            before *= total
 
-            count = information.count
-            remaining_spaces = len(information.spaces)
-            for space in information.spaces:
-                if rand.randint(1, remaining_spaces) <= count:
-                    count -= 1
-                    result[space] = 1
-                else:
-                    result[space] = 0
-                remaining_spaces -= 1
+        return result, before
 
-            return result
+    def get_float_probabilities(self):
+        """Like get_probabilities, but returns the probability of each space
+        as a float, and the natural logarithm of the number of arrangements.
+        This avoids multiplying the large counts of different clusters
+        together. Raises UnsolveableException if there are no arrangements."""
+        result = {}
+        log_total = 0.0
 
-        spaces = set()
-        for information in cluster:
-            spaces.update(information.spaces)
+        for possibilities, total in self.get_cluster_counts():
+            if total == 0:
+                raise UnsolveableException()
+            for space in possibilities:
+                result[space] = operator.truediv(possibilities[space], total)
+            log_total += math.log(total)
 
-        base_solver = Solver(spaces)
+        return result, log_total
 
-        for information in cluster:
-            base_solver.add_information(information)
+    @staticmethod
+    def get_cluster_possibility(cluster, rand, options=None):
+        return ClusterSampler(cluster, options).sample(rand)
+
+    def get_possibilities(self, number, rand=None, total=None):
+        """Returns a list of number arrangements of mines, each chosen uniformly
+        at random from those that fit the information, as dictionaries
+        mapping spaces to values. The arrangements are counted once, and each
+        cluster keeps its ClusterSampler until it changes, so further calls
+        only need to draw the samples.
+
+        Spaces that no information is known about are left out, unless total
+        is given. Then the arrangements also have total mines over all of the
+        spaces, without adding that as an information: the number of mines in
+        each cluster, and in the other spaces, is chosen first, and each
+        cluster is then sampled with that many."""
+        self.solve(np=False)
+        self.get_clusters()
 
-        information1 = information
+        if rand is None:
+            import random
+            rand = random.Random()
+            rand.seed()
 
-        # try to choose the same set of spaces as get_cluster_probabilities,
-        # so we can benefit from caching
-        for information in cluster:
-            if information is not information1 and not information.spaces.isdisjoint(information1.spaces):
-                spaces = information.spaces.intersection(information1.spaces)
-                max_mines = min(len(spaces), information.count, information1.count)
-                break
-        else:
-            raise Exception("This shouldn't happen")
+        samplers = []
+        for cluster in self.clusters:
+            if cluster.sampler is None:
+                cluster.sampler = ClusterSampler(cluster.frozen, self)
+            samplers.append(cluster.sampler)
+
+        if total is not None:
+            unconstrained_spaces = [space for space in self.spaces
+                if space not in self.solved_spaces and not self.get_informations_for_space(space)]
+            polynomials = [sampler.get_mine_polynomial() for sampler in samplers]
+            polynomials.append([choose(len(unconstrained_spaces), i) for i in range(len(unconstrained_spaces)+1)])
+            count = total - sum(self.solved_spaces.itervalues())
+            if count < 0:
+                raise UnsolveableException()
+            suffixes = get_suffix_products(polynomials, count + 1)
+            if count >= len(suffixes[0]) or not suffixes[0][count]:
+                raise UnsolveableException()
+
+        result = []
+        for i in xrange(number):
+            possibility = self.solved_spaces.copy()
+            if total is None:
+                for sampler in samplers:
+                    sampler.sample(rand, possibility)
+            else:
+                counts = choose_counts(polynomials, suffixes, count, rand)
+                for sampler, mines in itertools.izip(samplers, counts):
+                    sampler.sample_with_mines(rand, mines, possibility)
+                for space in unconstrained_spaces:
+                    possibility[space] = 0
+                for space in rand.sample(unconstrained_spaces, counts[-1]):
+                    possibility[space] = 1
+            result.append(possibility)
 
-        total = 0
-        possibilities = [0] * (max_mines+1)
-        solvers = [None] * (max_mines+1)
+        return result
 
-        for i in range(max_mines+1):
-            solver = base_solver.copy()
-            try:
-                solver.add_information(Information(spaces, i))
-                _solver_possibilities, possibilities[i] = solver.get_probabilities()
-                solvers[i] = solver
-            except UnsolveableException:
-                possibilities.append 
-                continue
-            total += possibilities[i]
+    def get_possibility(self, rand=None, total=None):
+        return self.get_possibilities(1, rand, total)[0]
 
-        n = rand.randint(1, total)
-        for i in range(max_mines+1):
-            n -= possibilities[i]
-            if n <= 0:
+    @staticmethod
+    def find_arrangement(informations, rand, deadline=None):
+        """Returns one arrangement of mines that fits informations, without
+        counting them, by giving spaces random values and backtracking when
+        that makes the informations unsolveable. Returns None if time.time()
+        passes deadline first."""
+        solver = Solver.solver_from_cluster(informations)
+        solver.solve(np=False)
+
+        # a list of [space, values not yet tried], and the marks to roll back
+        # the values that are in use
+        stack = []
+        marks = []
+        while True:
+            if deadline is not None and time.time() >= deadline:
+                return None
+
+            unsolved_spaces = [space for space in solver.spaces if space not in solver.solved_spaces]
+            if not unsolved_spaces:
+                return solver.solved_spaces.copy()
+
+            space = max(unsolved_spaces, key=lambda space: len(solver.get_informations_for_space(space)))
+            values = [0, 1]
+            rand.shuffle(values)
+            stack.append([space, values])
+
+            while True:
+                space, values = stack[-1]
+                if not values:
+                    stack.pop()
+                    if not stack:
+                        raise UnsolveableException()
+                    solver.rollback(marks.pop())
+                    continue
+                mark = solver.checkpoint()
+                try:
+                    solver.add_known_value(space, values.pop())
+                    solver.solve(np=False)
+                except UnsolveableException:
+                    solver.rollback(mark)
+                    continue
+                marks.append(mark)
                 break
 
-        return solvers[i].get_possibility()
+    def estimate_probabilities(self, time_limit=1.0, max_steps=None, chains=4, rand=None, max_block_spaces=16):
+        """Estimates the probabilities that get_probabilities would find, for
+        boards where counting the arrangements takes too long. Clusters with a
+        single information are counted exactly. For the others, chains
+        Markov chains (see GibbsChain), each starting from an arrangement found
+        by find_arrangement, are run until time_limit seconds have passed or
+        each has taken max_steps steps. The first half of each chain is
+        discarded. Finding the starting arrangements counts against
+        time_limit, and only the chains started in time are run. If no chain
+        takes a step, the estimated spaces are left out of the probabilities
+        and r_hat is infinite. Returns an Estimate."""
+        deadline = time.time() + time_limit
 
-    def get_possibility(self, rand=None):
         self.solve(np=False)
-        clusters = self.get_clusters()
-        result = self.solved_spaces.copy()
+        self.get_clusters()
 
         if rand is None:
             import random
             rand = random.Random()
             rand.seed()
 
-        for cluster in clusters:
-            result.update(Solver.get_cluster_possibility(cluster, rand))
+        probabilities = {}
+        errors = {}
+        informations = []
+        for cluster in self.clusters:
+            if len(cluster) == 1:
+                for information in cluster.informations:
+                    for space in information.spaces:
+                        probabilities[space] = operator.truediv(information.count, len(information.spaces))
+                        errors[space] = 0.0
+            else:
+                informations.extend(cluster.informations)
 
-        return result
+        if not informations:
+            return Estimate(probabilities, errors, 0, 1.0)
+
+        informations_for_space = collections.defaultdict(list)
+        for information in informations:
+            for space in information.spaces:
+                informations_for_space[space].append(information)
+
+        gibbs_chains = []
+        for i in range(chains):
+            arrangement = Solver.find_arrangement(informations, rand, deadline)
+            if arrangement is None:
+                break
+            gibbs_chains.append(GibbsChain(informations_for_space, informations, arrangement, max_block_spaces))
+
+        if not gibbs_chains:
+            return Estimate(probabilities, errors, 0, float('inf'))
+
+        # Snapshots are taken every interval steps. When there are too many,
+        # every other one is dropped and the interval doubled.
+        interval = 8
+        max_snapshots = 40
+        while time.time() < deadline and (max_steps is None or gibbs_chains[0].steps < max_steps):
+            for chain in gibbs_chains:
+                chain.step(rand)
+            if gibbs_chains[0].steps % interval == 0:
+                for chain in gibbs_chains:
+                    chain.snapshots.append(chain.snapshot())
+                if len(gibbs_chains[0].snapshots) > max_snapshots:
+                    for chain in gibbs_chains:
+                        chain.snapshots = chain.snapshots[::2]
+                    interval *= 2
+
+        steps = gibbs_chains[0].steps
+        if steps == 0:
+            return Estimate(probabilities, errors, 0, float('inf'))
+
+        ends = [chain.snapshot() for chain in gibbs_chains]
+        first = len(gibbs_chains[0].snapshots) // 2
+
+        chain_means = []
+        batch_means = []
+        for chain, (end_steps, end_mine_steps) in zip(gibbs_chains, ends):
+            start_steps, start_mine_steps = chain.snapshots[first]
+            if end_steps == start_steps:
+                start_steps, start_mine_steps = chain.snapshots[0]
+            chain_means.append(dict((space, operator.truediv(end_mine_steps[space] - start_mine_steps[space],
+                    max(end_steps - start_steps, 1)))
+                for space in end_mine_steps))
+            for (steps1, mine_steps1), (steps2, mine_steps2) in zip(chain.snapshots[first:], chain.snapshots[first+1:]):
+                batch_means.append(dict((space, operator.truediv(mine_steps2[space] - mine_steps1[space], steps2 - steps1))
+                    for space in mine_steps2))
+
+        r_hat = 1.0
+        for space in informations_for_space:
+            means = [chain_mean[space] for chain_mean in chain_means]
+            probability = sum(means) / len(means)
+            probabilities[space] = probability
+
+            if len(batch_means) > 1:
+                batch_values = [batch_mean[space] for batch_mean in batch_means]
+                variance = sum((value - probability) ** 2 for value in batch_values) / (len(batch_values) - 1)
+                errors[space] = 1.96 * math.sqrt(variance / len(batch_values))
+            else:
+                errors[space] = 1.0
+
+            if len(means) > 1 and steps > 1:
+                within = sum(mean * (1 - mean) for mean in means) / len(means)
+                between = sum((mean - probability) ** 2 for mean in means) / (len(means) - 1)
+                if within > 0:
+                    r_hat = max(r_hat, math.sqrt(((steps - 1.0) / steps * within + between) / within))
+                elif between > 0:
+                    r_hat = float('inf')
+
+        return Estimate(probabilities, errors, steps, r_hat)
 
     @staticmethod
     def solver_from_cluster(cluster):
@@ -376,9 +2260,7 @@ class Solver(object):
 
         result = Solver(spaces)
         for information in cluster:
-            result.information.add(information)
-            for space in information.spaces:
-                result.informations_for_space[space].add(information)
+            result.link_information(information)
 
         return result
 
@@ -402,20 +2284,20 @@ class Solver(object):
                     states_validated.update((space, 1) for space in cluster_solver.spaces)
                     continue
 
-                # Find a space in the most informations
-                max_space = None
-                max_information = 0
-                max_information_size = 0
-                for space in cluster_solver.spaces:
-                    if len(cluster_solver.informations_for_space[space]) > 1:
-                        i = iter(cluster_solver.informations_for_space[space])
-                        information1 = next(i)
-                        information2 = next(i)
-                        spaces = information1.spaces.intersection(information2.spaces)
-                        max_mines = min(len(spaces), information1.count, information2.count)
-                        break
-                else:
-                    assert False
+                # Find a space in the most informations, and split on the
+                # intersection of two of them that leaves the fewest cases
+                max_space = max(cluster_solver.spaces,
+                    key=lambda space: len(cluster_solver.get_informations_for_space(space)))
+                informations = list(cluster_solver.get_informations_for_space(max_space))
+                assert len(informations) > 1
+                max_mines = None
+                for index, information1 in enumerate(informations):
+                    for information2 in informations[index+1:]:
+                        intersection = information1.spaces.intersection(information2.spaces)
+                        mines = min(len(intersection), information1.count, information2.count)
+                        if max_mines is None or mines < max_mines:
+                            spaces = intersection
+                            max_mines = mines
 
                 first_attempt = 0
                 for space in spaces:
@@ -424,17 +2306,19 @@ class Solver(object):
                 if first_attempt > max_mines:
                     first_attempt = max_mines
 
+                cluster_solver.solve(np=False)
                 for i in range(max_mines+1):
                     if i == 0:
                         i = first_attempt
                     elif i == first_attempt:
                         i = 0
-                    check_solver = cluster_solver.copy()
+                    mark = cluster_solver.checkpoint()
                     try:
-                        check_solver.add_information(Information(spaces, i))
+                        cluster_solver.add_information(Information(spaces, i))
+                        res = cluster_solver.check_state(states_to_validate)
                     except UnsolveableException:
-                        continue
-                    res = check_solver.check_state(states_to_validate)
+                        res = False
+                    cluster_solver.rollback(mark)
                     if res:
                         break
                 else:
@@ -444,9 +2328,12 @@ class Solver(object):
 
             return states_validated
         else:
-            return solver.solved_spaces.iteritems()
+            return set(solver.solved_spaces.iteritems())
 
-    def solve_cluster(self, cluster):
+    @staticmethod
+    def find_cluster_contradiction(cluster):
+        """Looks for a value of a space in cluster that makes it unsolveable.
+        Returns (space, value) if there is one, or None."""
         base_solver = Solver.solver_from_cluster(cluster)
 
         spaces = base_solver.spaces
@@ -455,31 +2342,39 @@ class Solver(object):
         states_to_validate.update((x, 0) for x in spaces)
         states_to_validate.update((x, 1) for x in spaces)
 
+        base_solver.solve(np=False)
         while states_to_validate:
             space, value = states_to_validate.pop()
 
-            solver = base_solver.copy()
-
-            solver.add_known_value(space, value)
-
-            res = solver.check_state(states_to_validate)
+            mark = base_solver.checkpoint()
+            base_solver.add_known_value(space, value)
+            res = base_solver.check_state(states_to_validate)
+            base_solver.rollback(mark)
 
             if res:
                 states_validated = res
                 states_to_validate.difference_update(states_validated)
             else:
-                self.add_known_value(space, value ^ 1)
-                next(global_clusters_solves)
-                return True
+                return space, value
 
-        global_clusters_checked.add(cluster)
-        next(global_clusters_misses)
-        return False
+        return None
+
+    def finish_solve_cluster(self, cluster, contradiction):
+        if contradiction is None:
+            self.clusters_checked_cache.add(cluster)
+            return False
+        space, value = contradiction
+        self.add_known_value(space, value ^ 1)
+        next(global_clusters_solves)
+        return True
+
+    def solve_cluster(self, cluster):
+        return self.finish_solve_cluster(cluster, Solver.find_cluster_contradiction(cluster))
 
     def solve_np(self):
         clusters = self.get_clusters()
 
-        promises = []
+        futures = []
 
         res = False
 
@@ -487,104 +2382,443 @@ class Solver(object):
             if len(cluster) <= 2:
                 continue
 
-            if cluster in global_clusters_checked:
-                next(global_clusters_hits)
+            if self.clusters_checked_cache.get(cluster):
                 continue
 
-            promises.append(queue.add_task(Solver.solve_cluster, args=(self, cluster)))
+            if Solver.use_process_pool(cluster, self):
+                futures.append((cluster, get_process_pool(self.processes).apply_async(
+                    solve_cluster_task, (cluster,))))
+            else:
+                futures.append((cluster, executor.add_task(Solver.find_cluster_contradiction, args=(cluster,))))
 
-        for promise in promises:
-            if promise.get():
+        for cluster, future in futures:
+            # Once one cluster has given us a space, the caller will propagate
+            # it and try again, so there's no need to start on the others.
+            if res and isinstance(future, Future) and future.cancel():
+                continue
+            if self.finish_solve_cluster(cluster, future.get()):
                 res = True
 
         return res
 
     def solve(self, np=True):
+        # Known values are cheapest to use and can only make informations
+        # smaller, so they go first, then informations from smallest up.
+        rule_counts = self.rule_counts
         while True:
             if self.spaces_to_add:
-                space, value = self.spaces_to_add.pop()
+                space, value = self.spaces_to_add.popitem()
 
+                if value is None:
+                    raise UnsolveableException
                 if space in self.solved_spaces:
                     if self.solved_spaces[space] != value:
                         raise UnsolveableException
                     continue
-                for information in list(self.informations_for_space.get(space, ())):
+                for information in list(self.get_informations_for_space(space)):
                     new_information = Information(
                         information.spaces.difference((space,)),
                         information.count - value)
                     self.remove_information(information)
                     self.add_information(new_information)
-                self.solved_spaces[space] = value
+                    rule_counts['known'] += 1
+                self.set_solved_value(space, value)
             elif self.informations_to_add:
-                information = self.informations_to_add.pop()
-
-                modified = False
-                for space in information.spaces:
-                    if space in self.solved_spaces:
-                        information = Information(
-                            information.spaces.difference((space,)),
-                            information.count - self.solved_spaces[space])
-                        modified = True
-                if modified:
-                    self.add_information(information)
+                num_spaces, sequence, information = heapq.heappop(self.informations_to_add)
+                self.pending_informations.remove(information)
+
+                new_information = self.remove_solved_spaces(information)
+                if new_information is not information:
+                    self.add_information(new_information)
+                    rule_counts['solved'] += 1
                     continue
 
                 if information in self.information:
                     continue
 
-                intersecting_informations = set()
-                for space in information.spaces:
-                    intersecting_informations.update(self.informations_for_space.get(space, ()))
-
-                for other_information in intersecting_informations:
-                    if information.spaces.issubset(other_information.spaces):
-                        new_information = Information(
-                            other_information.spaces.difference(information.spaces),
-                            other_information.count - information.count)
-                        self.remove_information(other_information)
-                        self.add_information(new_information)
-
-                    elif other_information.spaces.issubset(information.spaces):
-                        new_information = Information(
-                            information.spaces.difference(other_information.spaces),
-                            information.count - other_information.count)
-                        self.add_information(new_information)
-                        break
-
-                    elif other_information.count - len(other_information.spaces.difference(information.spaces)) >= information.count:
-                        for space in other_information.spaces.difference(information.spaces):
-                            self.add_known_value(space, 1)
-                        for space in information.spaces.difference(other_information.spaces):
-                            self.add_known_value(space, 0)
-
-                    elif information.count - len(information.spaces.difference(other_information.spaces)) >= other_information.count:
-                        for space in other_information.spaces.difference(information.spaces):
-                            self.add_known_value(space, 0)
-                        for space in information.spaces.difference(other_information.spaces):
-                            self.add_known_value(space, 1)
-                else:
-                    self.information.add(information)
-                    for space in information.spaces:
-                        self.informations_for_space[space].add(information)
+                self.use_information(information)
 
             elif not np or not self.solve_np():
                 break
 
+    def use_information(self, information):
+        """Uses a new information with the informations that share spaces with
+        it, and links it if nothing makes it redundant."""
+        rule_counts = self.rule_counts
+        spaces = information.spaces
+        count = information.count
+
+        # Subsets and supersets reduce informations without guessing, so
+        # they're looked for before the overlap rules.
+        supersets = []
+        overlaps = []
+        for other_information in self.get_intersecting_informations(information):
+            if other_information.spaces.issubset(spaces):
+                self.add_information(Information(
+                    spaces.difference(other_information.spaces),
+                    count - other_information.count))
+                rule_counts['subset'] += 1
+                return
+            elif spaces.issubset(other_information.spaces):
+                supersets.append(other_information)
+            else:
+                overlaps.append(other_information)
+
+        for other_information in supersets:
+            self.remove_information(other_information)
+            self.add_information(Information(
+                other_information.spaces.difference(spaces),
+                other_information.count - count))
+            rule_counts['superset'] += 1
+
+        for other_information in overlaps:
+            other_spaces = other_information.spaces
+            if other_information.count - len(other_spaces.difference(spaces)) >= count:
+                for space in other_spaces.difference(spaces):
+                    self.add_known_value(space, 1)
+                for space in spaces.difference(other_spaces):
+                    self.add_known_value(space, 0)
+                rule_counts['overlap'] += 1
+
+            elif count - len(spaces.difference(other_spaces)) >= other_information.count:
+                for space in other_spaces.difference(spaces):
+                    self.add_known_value(space, 0)
+                for space in spaces.difference(other_spaces):
+                    self.add_known_value(space, 1)
+                rule_counts['overlap'] += 1
+
+        self.link_information(information)
+
+class BitSpaces(long):
+    """An immutable set of non-negative integers, stored as the bits of a long.
+
+    This implements the parts of the frozenset interface that Solver uses, so
+    that Information objects built from it can be used in place of ones built
+    from frozensets. Operations on other BitSpaces objects do not need to hash
+    anything, and len() is a popcount."""
+
+    __slots__ = ()
+
+    def __new__(cls, indices=0):
+        if isinstance(indices, (int, long)):
+            return long.__new__(cls, indices)
+        mask = 0
+        for index in indices:
+            mask |= 1 << index
+        return long.__new__(cls, mask)
+
+    @staticmethod
+    def _mask(other):
+        if isinstance(other, (int, long)):
+            return other
+        mask = 0
+        for index in other:
+            mask |= 1 << index
+        return mask
+
+    def lowest(self):
+        return (self & -self).bit_length() - 1
+
+    def __len__(self):
+        if not self:
+            return 0
+        return bin(self >> self.lowest()).count('1')
+
+    def __iter__(self):
+        # Searching the binary representation is much faster than shifting
+        # through the mask one bit at a time in Python. Shift off the low
+        # zeros first so that a few high spaces only make a short string.
+        if not self:
+            return
+        lowest = self.lowest()
+        bits = bin(self >> lowest)[:1:-1]
+        index = 0
+        while index != -1:
+            yield index + lowest
+            index = bits.find('1', index + 1)
+
+    def __contains__(self, index):
+        return bool((self >> index) & 1)
+
+    def __repr__(self):
+        return 'BitSpaces(%r)' % sorted(self)
+
+    def difference(self, other):
+        return BitSpaces(self & ~BitSpaces._mask(other))
+
+    def intersection(self, other):
+        return BitSpaces(self & BitSpaces._mask(other))
+
+    def union(self, other):
+        return BitSpaces(self | BitSpaces._mask(other))
+
+    def issubset(self, other):
+        return not self & ~BitSpaces._mask(other)
+
+    def issuperset(self, other):
+        return not BitSpaces._mask(other) & ~self
+
+    def isdisjoint(self, other):
+        return not self & BitSpaces._mask(other)
+
+class IndexSolver(Solver):
+    """A Solver for spaces numbered 0 to n-1, with BitSpaces informations.
+
+    The solved spaces are also kept as masks, so removing them from an
+    information takes a couple of long operations. Informations with more than
+    large_information_size spaces (such as the total number of mines) are not
+    added to informations_for_space; they are kept in a separate set and
+    found with a mask test instead."""
+
+    large_information_size = 64
+
+    def is_large(self, information):
+        # Checking the span of the mask is cheaper than a popcount, so only
+        # count the spaces when the span is large.
+        spaces = information.spaces
+        return bool(spaces >> (spaces.lowest() + self.large_information_size)) and \
+            len(spaces) > self.large_information_size
+
+    def __init__(self, spaces, engine=None):
+        Solver.__init__(self, spaces)
+        self.solved_mask = 0
+        self.mines_mask = 0
+        self.large_informations = set()
+        # counts changes to solved_spaces and information, so that BitsetSolver
+        # knows when to translate them again
+        self.changes = 0
+
+    def index_information(self, information):
+        self.changes += 1
+        if self.is_large(information):
+            self.large_informations.add(information)
+        else:
+            Solver.index_information(self, information)
+
+    def unindex_information(self, information):
+        self.changes += 1
+        if information in self.large_informations:
+            self.large_informations.remove(information)
+        else:
+            Solver.unindex_information(self, information)
+
+    def get_informations_for_space(self, space):
+        result = list(self.informations_for_space.get(space, ()))
+        bit = 1 << space
+        for information in self.large_informations:
+            if information.spaces & bit:
+                result.append(information)
+        return result
+
+    def get_intersecting_informations(self, information):
+        spaces = information.spaces
+        if self.is_large(information):
+            return [other_information for other_information in self.information
+                if other_information.spaces & spaces]
+        result = Solver.get_intersecting_informations(self, information)
+        for other_information in self.large_informations:
+            if other_information.spaces & spaces:
+                result.add(other_information)
+        return result
+
+    def set_solved_value(self, space, value):
+        self.changes += 1
+        Solver.set_solved_value(self, space, value)
+        self.solved_mask |= 1 << space
+        if value:
+            self.mines_mask |= 1 << space
+
+    def unset_solved_value(self, space):
+        self.changes += 1
+        Solver.unset_solved_value(self, space)
+        self.solved_mask &= ~(1 << space)
+        self.mines_mask &= ~(1 << space)
+
+    def remove_solved_spaces(self, information):
+        solved = information.spaces & self.solved_mask
+        if not solved:
+            return information
+        return Information(
+            BitSpaces(information.spaces & ~solved),
+            information.count - len(BitSpaces(solved & self.mines_mask)))
+
+    def freeze_cluster(self, cluster):
+        # Clusters are usually small, and frozensets are faster than masks
+        # for small sets, so the clusters are given to the rest of the solver
+        # as ordinary Information objects over the indices.
+        return frozenset(Information(frozenset(information.spaces), information.count)
+            for information in cluster.informations)
+
+    def copy(self):
+        result = Solver.copy(self)
+        result.solved_mask = self.solved_mask
+        result.mines_mask = self.mines_mask
+        result.large_informations = self.large_informations.copy()
+        result.changes = self.changes
+        return result
+
+class BitsetSolver(object):
+    """A Solver that works on dense integer indices internally.
+
+    The spaces given to the constructor are numbered once, and each Information
+    is translated to a BitSpaces mask before it reaches the underlying Solver.
+    The public methods and attributes documented in the README use the original
+    space identifiers and give the same results as a Solver's. Create one with
+    Solver(spaces, engine='bitset').
+
+    It is not a subclass of Solver, and has none of the methods that work on a
+    Solver's internal state. solved_spaces and information are translated
+    copies, which are kept until the solver changes, so they must not be
+    modified: the changes would not reach the solver."""
+
+    def __init__(self, spaces, engine=None):
+        self.spaces = frozenset(spaces)
+        self.index_to_space = tuple(self.spaces)
+        self.space_to_index = dict((space, index) for (index, space) in enumerate(self.index_to_space))
+        self.solver = IndexSolver(xrange(len(self.index_to_space)))
+        # (self.solver.changes, translated value) for solved_spaces and information
+        self.solved_spaces_view = (None, None)
+        self.information_view = (None, None)
+
+    def information_to_indices(self, information):
+        space_to_index = self.space_to_index
+        mask = 0
+        for space in information.spaces:
+            mask |= 1 << space_to_index[space]
+        return Information(BitSpaces(mask), information.count)
+
+    def information_from_indices(self, information):
+        index_to_space = self.index_to_space
+        return Information(frozenset(index_to_space[index] for index in information.spaces), information.count)
+
+    def dict_from_indices(self, d):
+        index_to_space = self.index_to_space
+        return dict((index_to_space[index], value) for (index, value) in d.iteritems())
+
+    @property
+    def solved_spaces(self):
+        changes, result = self.solved_spaces_view
+        if changes != self.solver.changes:
+            result = self.dict_from_indices(self.solver.solved_spaces)
+            self.solved_spaces_view = (self.solver.changes, result)
+        return result
+
+    @property
+    def information(self):
+        changes, result = self.information_view
+        if changes != self.solver.changes:
+            result = set(self.information_from_indices(information) for information in self.solver.information)
+            self.information_view = (self.solver.changes, result)
+        return result
+
+    def get_informations_for_space(self, space):
+        index = self.space_to_index.get(space)
+        if index is None:
+            return ()
+        return [self.information_from_indices(information)
+            for information in self.solver.get_informations_for_space(index)]
+
+    def __getattr__(self, name):
+        if name in Solver.options:
+            return getattr(self.solver, name)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in Solver.options:
+            setattr(self.solver, name, value)
+        else:
+            object.__setattr__(self, name, value)
+
+    def add_information(self, information):
+        self.solver.add_information(self.information_to_indices(information))
+
+    def remove_information(self, information):
+        self.solver.remove_information(self.information_to_indices(information))
+
+    def add_known_value(self, space, value):
+        self.solver.add_known_value(self.space_to_index[space], value)
+
+    def copy(self):
+        result = object.__new__(BitsetSolver)
+        result.spaces = self.spaces
+        result.index_to_space = self.index_to_space
+        result.space_to_index = self.space_to_index
+        result.solver = self.solver.copy()
+        result.solved_spaces_view = (None, None)
+        result.information_view = (None, None)
+        return result
+
+    @property
+    def rule_counts(self):
+        return self.solver.rule_counts
+
+    # these only use the public interface, which translates the spaces
+    add_board = Solver.__dict__['add_board']
+    add_grid = Solver.__dict__['add_grid']
+
+    def checkpoint(self):
+        return self.solver.checkpoint()
+
+    def rollback(self, mark):
+        self.solver.rollback(mark)
+
+    def release(self, mark):
+        self.solver.release(mark)
+
+    def changes_from_indices(self, changes):
+        return Changes(self.dict_from_indices(changes.solved),
+            set(self.information_from_indices(information) for information in changes.added),
+            set(self.information_from_indices(information) for information in changes.removed))
+
+    def get_changes(self, mark):
+        return self.changes_from_indices(self.solver.get_changes(mark))
+
+    def try_information(self, information):
+        return self.changes_from_indices(self.solver.try_information(self.information_to_indices(information)))
+
+    def get_clusters(self):
+        index_to_space = self.index_to_space
+        return set(frozenset(Information(frozenset(index_to_space[index] for index in information.spaces), information.count)
+                for information in cluster)
+            for cluster in self.solver.get_clusters())
+
+    def get_probabilities(self):
+        probabilities, total = self.solver.get_probabilities()
+        return self.dict_from_indices(probabilities), total
+
+    def get_float_probabilities(self):
+        probabilities, log_total = self.solver.get_float_probabilities()
+        return self.dict_from_indices(probabilities), log_total
+
+    def get_space_probabilities(self, spaces):
+        space_to_index = self.space_to_index
+        return self.dict_from_indices(self.solver.get_space_probabilities(
+            space_to_index[space] for space in spaces))
+
+    def get_possibility(self, rand=None, total=None):
+        return self.dict_from_indices(self.solver.get_possibility(rand, total))
+
+    def get_possibilities(self, number, rand=None, total=None):
+        return [self.dict_from_indices(possibility)
+            for possibility in self.solver.get_possibilities(number, rand, total)]
+
+    def estimate_probabilities(self, *args, **kwargs):
+        probabilities, errors, steps, r_hat = self.solver.estimate_probabilities(*args, **kwargs)
+        return Estimate(self.dict_from_indices(probabilities), self.dict_from_indices(errors), steps, r_hat)
+
+    def solve(self, np=True):
+        self.solver.solve(np)
+
 def picma_main(width, height):
+    import boardparser
+
     spaces = set((x,y) for x in range(width) for y in range(height))
 
     solver = Solver(spaces)
 
-    for y in range(height):
-        for x in range(width):
-            char = sys.stdin.read(1)
-            while char not in '-0123456789':
-                char = sys.stdin.read(1)
-
-            if char.isdigit():
-                info_count = int(char)
-                info_spaces = frozenset((xs,ys) for xs in range(x-1, x+2) for ys in range(y-1, y+2)).intersection(spaces)
-                solver.add_information(Information(info_spaces, info_count))
+    cells = boardparser.BoardReader(sys.stdin, boardparser.PICMA_CELLS).read_board(width, height)
+    for info_spaces, info_count in boardparser.get_grid_constraints(width, height, cells, include_center=True):
+        solver.add_information(Information(info_spaces, info_count))
 
     try:
         solver.solve()
@@ -601,27 +2835,15 @@ def picma_main(width, height):
         print i
 
 def mines_main(width, height, total):
+    import boardparser
+
     spaces = set((x,y) for x in range(width) for y in range(height))
 
     solver = Solver(spaces)
 
-    for y in range(height):
-        for x in range(width):
-            char = sys.stdin.read(1)
-            while char not in '-0123456789m':
-                char = sys.stdin.read(1)
-
-            if char.isdigit():
-                info_count = int(char)
-                info_spaces = frozenset((xs,ys) for xs in range(x-1, x+2) for ys in range(y-1, y+2)).intersection(spaces)
-                solver.add_information(Information(info_spaces, info_count))
-                solver.add_known_value((x, y), 0)
-            elif char == 'm':
-                solver.add_known_value((x, y), 1)
-
-    solver.add_information(Information(frozenset(spaces), total))
-
+    cells = boardparser.BoardReader(sys.stdin, boardparser.MINES_CELLS).read_board(width, height)
     try:
+        solver.add_grid(width, height, cells, total)
         solver.solve()
     except UnsolveableException:
         print "This configuration has no solutions."
@@ -650,9 +2872,58 @@ def mines_main(width, height, total):
     for probability, space in probabilities:
         print space, probability / total
 
+def solve_record(record):
+    """Solves a board given as a dictionary with width, height, cells (as for
+    Solver.add_grid) and optionally total and id. Returns a dictionary with the
+    id, the solved cells as a string in the same layout, the number of
+    arrangements, and a list of [x, y, probability] for the unknown spaces, or
+    the id and an error message."""
+    result = {'id': record.get('id')}
+    try:
+        width = record['width']
+        height = record['height']
+        solver = Solver((x, y) for y in xrange(height) for x in xrange(width))
+        solver.add_grid(width, height, record['cells'], record.get('total'))
+        solver.solve()
+        probabilities, arrangements = solver.get_probabilities()
+    except UnsolveableException:
+        result['error'] = 'unsolveable'
+        return result
+    except (KeyError, TypeError, ValueError), e:
+        result['error'] = 'invalid record: %s' % (e,)
+        return result
+
+    result['solved'] = ''.join(str(solver.solved_spaces.get((x, y), '-'))
+        for y in xrange(height) for x in xrange(width))
+    result['arrangements'] = arrangements
+    result['probabilities'] = [[x, y, operator.truediv(probability, arrangements)]
+        for (x, y), probability in sorted(probabilities.iteritems(), key=lambda item: item[0][::-1])]
+    return result
+
+def batch_main(infile=sys.stdin, outfile=sys.stdout):
+    """Reads one JSON record per line, as described in solve_record, and writes
+    one JSON result per line. All boards share the solver caches."""
+    for line in infile:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError, e:
+            result = {'id': None, 'error': 'invalid record: %s' % (e,)}
+        else:
+            if isinstance(record, dict):
+                result = solve_record(record)
+            else:
+                result = {'id': None, 'error': 'invalid record: expected an object'}
+        outfile.write(json.dumps(result, sort_keys=True))
+        outfile.write('\n')
+        outfile.flush()
+
 class MineMap(object):
-    def __init__(self, spaces):
+    def __init__(self, spaces, geometry=None):
         self.spaces = frozenset(spaces)
+        self.geometry = geometry
 
     def __getitem__(self, key):
         raise NotImplementedError()
@@ -661,33 +2932,35 @@ class MineMap(object):
         raise NotImplementedError()
 
     def get_bordering_spaces(self, space):
-        raise NotImplementedError()
+        """Returns a frozenset of space and the spaces next to it."""
+        if self.geometry is None:
+            raise NotImplementedError()
+        return self.geometry.get_neighbourhood(space)
 
     def randomize_p(self, random, p=0.5):
         for space in self.spaces:
             self[space] = 1 if random.random() < p else 0
 
     def randomize_count(self, random, count):
-        mines_remaining = count
-        spaces_remaining = len(self.spaces)
+        mine_spaces = frozenset(random.sample(list(self.spaces), count))
         for space in self.spaces:
-            value = 1 if random.randint(1, spaces_remaining) < mines_remaining else 0
-            self[space] = value
-            mines_remaining -= value
-            spaces_remaining -= 1
+            self[space] = 1 if space in mine_spaces else 0
+
+# for RectMap.randomize_p, turns a string of binary digits into values
+_bit_values = string.maketrans('01', '\x00\x01')
 
 class RectMap(MineMap):
+    """A rectangle of (x, y) spaces. values is a bytearray with one byte for
+    each space, row by row, so (x, y) is at x + y * width."""
+
     def __init__(self, width, height):
-        spaces = set()
-        for x in range(width):
-            for y in range(height):
-                spaces.add((x, y))
-        MineMap.__init__(self, spaces)
+        rect = geometry.rect(width, height)
+        MineMap.__init__(self, rect.spaces, rect)
 
         self.width = width
         self.height = height
 
-        self.values = [0] * width * height
+        self.values = bytearray(width * height)
 
     def __getitem__(self, key):
         x, y = key
@@ -697,19 +2970,95 @@ class RectMap(MineMap):
         x, y = key
         self.values[x + y * self.width] = value
 
-    def get_bordering_spaces(self, space):
-        result = set()
-        x, y = space
-        for xb in range(max(x-1, 0), min(x+2, self.width)):
-            for yb in range(max(y-1, 0), min(y+2, self.height)):
-                result.add((xb, yb))
+    # The values are replaced in place, so arrays from get_array still see them.
+
+    def randomize_p(self, random, p=0.5):
+        size = len(self.values)
+        if not size:
+            return
+        if p == 0.5:
+            bits = bin(random.getrandbits(size))[2:].zfill(size)
+            self.values[:] = bits.translate(_bit_values)
+        else:
+            self.values[:] = bytearray(random.random() < p for i in xrange(size))
+
+    def randomize_count(self, random, count):
+        values = bytearray(len(self.values))
+        for index in random.sample(xrange(len(values)), count):
+            values[index] = 1
+        self.values[:] = values
+
+    def get_array(self):
+        """Returns a height by width NumPy array that shares its memory with
+        values, so changes to either show in the other."""
+        return numpy.frombuffer(self.values, dtype=numpy.uint8).reshape(self.height, self.width)
+
+    def get_neighbour_sums(self, include_center=True):
+        """Returns a bytearray with the number of mines around each space, row
+        by row, counting the space itself if include_center is set."""
+        width, height = self.width, self.height
+        values = self.values
+        if numpy is not None:
+            array = self.get_array()
+            sums = neighbourhood_sum(array)
+            if not include_center:
+                sums -= array
+            return bytearray(sums.astype(numpy.uint8).tostring())
+
+        # sums of each space and the ones to its left and right, then of those
+        # sums for each row and the rows above and below it
+        zero = bytearray(1)
+        rows = []
+        for y in xrange(height):
+            row = zero + values[y*width:(y+1)*width] + zero
+            rows.append([a + b + c for (a, b, c) in itertools.izip(row, row[1:], row[2:])])
+        empty = [0] * width
+        result = bytearray()
+        for y in xrange(height):
+            above = rows[y-1] if y else empty
+            below = rows[y+1] if y+1 < height else empty
+            result.extend(a + b + c for (a, b, c) in itertools.izip(above, rows[y], below))
+        if not include_center:
+            result = bytearray(a - b for (a, b) in itertools.izip(result, values))
         return result
 
+    def get_grid(self, revealed=()):
+        """Returns the cells to pass to Solver.add_grid for this map with the
+        spaces in revealed uncovered: 'm' for a mine, the number of mines next
+        to it for a clear space, and '-' for the spaces not in revealed."""
+        width = self.width
+        values = self.values
+        sums = self.get_neighbour_sums(False)
+        cells = bytearray('-' * len(values))
+        for x, y in revealed:
+            index = x + y * width
+            cells[index] = ord('m') if values[index] else ord('0') + sums[index]
+        return str(cells)
+
 class PicmaPuzzle(object):
+    # options:
+
+    # number of worker processes that make_solveable tries clues in, or 0 to
+    # try them one at a time in this process (see WorkerSolvers)
+    processes = 0
+
+    # number of clues make_solveable gives each worker process at once
+    clues_per_process = 4
+
+    # how many times trim grows the area around a clue, one space in each
+    # direction, when it looks for another way to fill it in (see
+    # find_local_alternative)
+    trim_search_steps = 2
+
     def __init__(self, minemap):
         self.minemap = minemap
         self.known_spaces = dict()
 
+    def get_clue(self, space):
+        """Returns the Information that revealing space would give."""
+        bordering_spaces = frozenset(self.minemap.get_bordering_spaces(space))
+        return Information(bordering_spaces, sum(self.minemap[s] for s in bordering_spaces))
+
     def create_solver(self):
         result = Solver(self.minemap.spaces)
         for key, value in self.known_spaces.iteritems():
@@ -725,31 +3074,117 @@ class PicmaPuzzle(object):
         spaces_left_to_add = list(spaces_left_to_add)
         random.shuffle(spaces_left_to_add)
 
-        while len(self.minemap.spaces) != len(solver.solved_spaces):
-            if not spaces_left_to_add:
-                raise ValueError("Unsolveable configuration")
-            space = spaces_left_to_add.pop()
-            bordering_spaces = frozenset(self.minemap.get_bordering_spaces(space))
+        if self.processes and multiprocessing is not None:
+            workers = WorkerSolvers(solver, self.processes)
+        else:
+            workers = None
+
+        # A clue is kept if it changes anything the solver knows. Clues are
+        # tried with checkpoint and rollback, so the solver is never copied.
+        # misses is the number of clues in a row that didn't help.
+        misses = 0
+        try:
+            while len(self.minemap.spaces) != len(solver.solved_spaces):
+                if not spaces_left_to_add:
+                    raise ValueError("Unsolveable configuration")
+
+                if workers is None or misses < self.processes:
+                    space = spaces_left_to_add.pop()
+                    clue = self.get_clue(space)
+                    mark = solver.checkpoint()
+                    solver.add_information(clue)
+                    solver.solve()
+                    if any(solver.get_changes(mark)):
+                        self.known_spaces[space] = clue.count
+                        solver.release(mark)
+                        if workers is not None:
+                            workers.add_informations((clue,))
+                        misses = 0
+                    else:
+                        solver.rollback(mark)
+                        misses += 1
+                    continue
 
-            value = sum(self.minemap[s] for s in bordering_spaces)
+                # Once clues have stopped helping, try the next few at once
+                # against the current state. The ones before the first that
+                # helps would be dropped one at a time anyway, and the ones
+                # after it have to be tried again, so the number tried grows
+                # with the number of misses.
+                count = min(misses, self.processes * self.clues_per_process)
+                spaces = spaces_left_to_add[-count:][::-1]
+                clues = [self.get_clue(space) for space in spaces]
+                for space, clue, changes in zip(spaces, clues, workers.try_informations(clues)):
+                    spaces_left_to_add.pop()
+                    if any(changes):
+                        self.known_spaces[space] = clue.count
+                        solver.add_information(clue)
+                        solver.solve()
+                        workers.add_informations((clue,))
+                        misses = 0
+                        break
+                    misses += 1
+        finally:
+            if workers is not None:
+                workers.close()
+
+    def find_local_alternative(self, space, rand):
+        """Returns True if the spaces near space can be given values other than
+        the real ones without breaking any known space's clue but its own. That
+        proves its clue is needed, because the rest of the board could then be
+        solved two ways without it."""
+        region = set(self.minemap.get_bordering_spaces(space))
+        for i in xrange(self.trim_search_steps):
+            for s in list(region):
+                region.update(self.minemap.get_bordering_spaces(s))
+
+        # The other clues that reach into the region, with the spaces outside it
+        # given their real values.
+        informations = []
+        for key, value in self.known_spaces.iteritems():
+            if key == space:
+                continue
+            bordering_spaces = self.minemap.get_bordering_spaces(key)
+            inside = bordering_spaces.intersection(region)
+            if not inside:
+                continue
+            outside = sum(self.minemap[s] for s in bordering_spaces if s not in region)
+            informations.append(Information(frozenset(inside), value - outside))
 
-            new_solver = solver.copy()
-            new_solver.add_information(Information(bordering_spaces, value))
-            new_solver.solve()
+        # Any other arrangement breaks the clue at space, so it must change one
+        # of the spaces that clue covers.
+        for s in self.minemap.get_bordering_spaces(space):
+            try:
+                Solver.find_arrangement(informations + [Information(frozenset((s,)), 1 - self.minemap[s])], rand)
+            except UnsolveableException:
+                continue
+            return True
+        return False
 
-            if new_solver.solved_spaces != solver.solved_spaces or \
-                new_solver.information != solver.information:
-                self.known_spaces[space] = value
-                solver = new_solver
+    def trim(self, rand=None):
+        """Removes each known space in turn if the puzzle can still be solved
+        from the ones that are left."""
+        if rand is None:
+            import random
+            rand = random.Random()
 
-    def trim(self):
         for space, value in self.known_spaces.items():
+            if self.find_local_alternative(space, rand):
+                continue
             del self.known_spaces[space]
             solver = self.create_solver()
             solver.solve()
             if len(self.minemap.spaces) != len(solver.solved_spaces):
                 self.known_spaces[space] = value
 
+    def get_difficulty(self):
+        """Returns the number of times solving the puzzle has to try a value in
+        a space and find that it leads to a contradiction, or 0 if the simple
+        rules are enough."""
+        solver = self.create_solver()
+        start = next(global_clusters_solves)
+        solver.solve()
+        return next(global_clusters_solves) - start - 1
+
 
 def picmagen(rectmap, random):
     puzzle = PicmaPuzzle(rectmap)
@@ -762,15 +3197,15 @@ def picmagen(rectmap, random):
                 sys.stdout.write(str(rectmap[x, y]))
             sys.stdout.write('\n')
     else:
-        puzzle.trim()
+        puzzle.trim(random)
 
     for y in range(rectmap.height):
         for x in range(rectmap.width):
             sys.stdout.write(str(puzzle.known_spaces.get((x, y), '-')))
         sys.stdout.write('\n')
 
-    print "hits: ", next(global_clusters_hits)
-    print "misses: ", next(global_clusters_misses)
+    print "hits: ", global_clusters_checked.hits
+    print "misses: ", global_clusters_checked.misses
     print "solves: ", next(global_clusters_solves)
 
 def picmagen_main(width, height):
@@ -786,25 +3221,165 @@ def picmapregen_main(width, height):
     import random
     random = random.SystemRandom()
 
-    rectmap = RectMap(width, height)
+    import boardparser
 
-    for y in range(height):
-        for x in range(width):
-            char = sys.stdin.read(1)
-            while char not in '01':
-                char = sys.stdin.read(1)
+    rectmap = RectMap(width, height)
 
-            rectmap[x, y] = int(char)
+    cells = boardparser.BoardReader(sys.stdin, boardparser.PICMA_SOLUTION_CELLS).read_board(width, height)
+    for i, cell in enumerate(cells):
+        y, x = divmod(i, width)
+        rectmap[x, y] = int(cell)
 
     picmagen(rectmap, random)
 
+def picmagen_task(task):
+    """Generates puzzle number index of a picmagen_batch run, from its own
+    random.Random seeded with seed and jumped ahead by index, so the same
+    puzzle comes out whichever process makes it. Returns a dictionary with the
+    id, width, height, clues (row by row, as for picma_main), solution, number
+    of clues, difficulty (see PicmaPuzzle.get_difficulty) and the number of
+    solves it took, or the id, solves and an error. The error is
+    'unsolveable' when make_solveable raises ValueError, which happens when
+    even revealing every clue leaves some spaces unknown, as it does for more
+    than half of random 8x8 maps."""
+    width, height, seed, index = task
+
+    import random
+    rand = random.Random(seed)
+    rand.jumpahead(index)
+
+    rectmap = RectMap(width, height)
+    rectmap.randomize_p(rand)
+    puzzle = PicmaPuzzle(rectmap)
+
+    start = next(global_clusters_solves)
+    try:
+        puzzle.make_solveable(rand)
+    except ValueError:
+        return {'id': index, 'error': 'unsolveable', 'solves': next(global_clusters_solves) - start - 1}
+    puzzle.trim(rand)
+    solves = next(global_clusters_solves) - start - 1
+
+    spaces = [(x, y) for y in xrange(height) for x in xrange(width)]
+    return {
+        'id': index,
+        'width': width,
+        'height': height,
+        'clues': ''.join(str(puzzle.known_spaces.get(space, '-')) for space in spaces),
+        'solution': ''.join(str(rectmap[space]) for space in spaces),
+        'num_clues': len(puzzle.known_spaces),
+        'difficulty': puzzle.get_difficulty(),
+        'solves': solves,
+    }
+
+def picmagen_batch(width, height, count, outfile, seed=0, processes=0, min_difficulty=0,
+        max_difficulty=None, report=None, max_empty_rounds=25):
+    """Writes count picma puzzles to outfile as JSON, one per line, as each is
+    made (see picmagen_task). Puzzles are numbered from 0, and those that are
+    unsolveable or outside the difficulty range are skipped, so the same seed
+    always gives the same file, with any number of processes. With processes,
+    a multiprocessing pool of that many makes them. If max_empty_rounds rounds
+    in a row (of 4 puzzles per process) give no puzzle to keep, for example
+    because nothing is in the difficulty range, it stops early and sets
+    gave_up in the statistics. Returns a dictionary of statistics, and writes
+    them to report if it's given."""
+    if processes and multiprocessing is not None:
+        pool = multiprocessing.Pool(processes)
+        imap = pool.imap
+    else:
+        pool = None
+        imap = itertools.imap
+
+    # Puzzles are handed out a round at a time, so that no more are made after
+    # the last one that's needed than it takes to keep every process busy.
+    round_size = max(processes, 1) * 4
+    stats = dict(puzzles=0, generated=0, unsolveable=0, rejected=0, solves=0, gave_up=False)
+    start_time = time.time()
+    try:
+        index = 0
+        empty_rounds = 0
+        while stats['puzzles'] < count:
+            if max_empty_rounds is not None and empty_rounds == max_empty_rounds:
+                stats['gave_up'] = True
+                break
+            tasks = [(width, height, seed, i) for i in xrange(index, index + round_size)]
+            index += round_size
+            round_puzzles = stats['puzzles']
+            for record in imap(picmagen_task, tasks):
+                if stats['puzzles'] == count:
+                    break
+                stats['generated'] += 1
+                stats['solves'] += record['solves']
+                if 'error' in record:
+                    stats['unsolveable'] += 1
+                    continue
+                if record['difficulty'] < min_difficulty or \
+                    (max_difficulty is not None and record['difficulty'] > max_difficulty):
+                    stats['rejected'] += 1
+                    continue
+                outfile.write(json.dumps(record, sort_keys=True))
+                outfile.write('\n')
+                outfile.flush()
+                stats['puzzles'] += 1
+            if stats['puzzles'] == round_puzzles:
+                empty_rounds += 1
+            else:
+                empty_rounds = 0
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    stats['seconds'] = time.time() - start_time
+    if report is not None:
+        report.write('%i puzzles in %.3fs (%.3f puzzles/s)\n' % (stats['puzzles'], stats['seconds'],
+            stats['puzzles'] / stats['seconds'] if stats['seconds'] else 0.0))
+        report.write('%i generated, %i unsolveable, %i outside the difficulty range\n' % (
+            stats['generated'], stats['unsolveable'], stats['rejected']))
+        report.write('mean solves per puzzle generated: %.2f\n' % (
+            float(stats['solves']) / stats['generated'] if stats['generated'] else 0.0))
+        if stats['gave_up']:
+            report.write('gave up after %i rounds in a row without a puzzle to keep\n' % max_empty_rounds)
+    return stats
+
+def picmagen_batch_main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='mines.py picmagen-batch')
+    parser.add_argument('width', type=int)
+    parser.add_argument('height', type=int)
+    parser.add_argument('count', type=int)
+    parser.add_argument('-o', '--output', help='file to write the puzzles to (default: standard output)')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-p', '--processes', type=int, default=0)
+    parser.add_argument('--min-difficulty', type=int, default=0)
+    parser.add_argument('--max-difficulty', type=int)
+    parser.add_argument('--max-empty-rounds', type=int, default=25,
+        help='rounds in a row without a puzzle to keep before giving up (default: 25)')
+    options = parser.parse_args(args)
+
+    if options.output is None:
+        outfile = sys.stdout
+    else:
+        outfile = open(options.output, 'w')
+    try:
+        picmagen_batch(options.width, options.height, options.count, outfile, options.seed,
+            options.processes, options.min_difficulty, options.max_difficulty, sys.stderr,
+            options.max_empty_rounds)
+    finally:
+        if outfile is not sys.stdout:
+            outfile.close()
+
 if __name__ == '__main__':
     if sys.argv[1] == 'picma':
         picma_main(int(sys.argv[2]), int(sys.argv[3]))
     elif sys.argv[1] == 'mines':
         mines_main(int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]))
+    elif sys.argv[1] == 'batch':
+        batch_main()
     elif sys.argv[1] == 'picmagen':
         picmagen_main(int(sys.argv[2]), int(sys.argv[3]))
     elif sys.argv[1] == 'picmapregen':
         picmapregen_main(int(sys.argv[2]), int(sys.argv[3]))
+    elif sys.argv[1] == 'picmagen-batch':
+        picmagen_batch_main(sys.argv[2:])
 
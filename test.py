@@ -18,10 +18,16 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import collections
+import json
+import math
 import random
+import StringIO
 import sys
 import unittest
 
+import boardparser
+import geometry
 import mines
 
 class SolverTests(unittest.TestCase):
@@ -53,11 +59,31 @@ class SolverTests(unittest.TestCase):
         ('difference', ((1,0,1,2),(3,1,2,3,4),), (3,4), (0,), 2, ((1,1), (2,1))),
         ('3/3', ((1,0,1,2),(1,2,3,4),), (), (), 5, ((0,2), (1,2), (2,1), (3,2), (4,2))),
         ('badintersection', ((1,0,1,2,3),(3,1,2,3,4)), (), (), 0, ()),
+        ('total', ((1,0,1),(1,2,3),(3,0,1,2,3,4,5)), (), (), 8, ((0,4), (1,4), (2,4), (3,4), (4,4), (5,4))),
+        ('total2', ((1,0,1),(1,1,2),(1,3,4),(3,0,1,2,3,4,5)), (), (), 4, ((0,2), (1,2), (2,2), (3,2), (4,2), (5,2))),
         ('auto1', ((6,1,2,4,6,7,9,11,13),(3,3,4,13,6),(3,0,1,2,3,5,8,10,11,12),(3,10,5,13,7)), (4,6,7,13), (3,), 24, ()),
     )
 
     longMessage = True
 
+    engine = None
+    counter = 'split'
+    processes = 0
+
+    def setUp(self):
+        # a cache for each test, so that one counter can't reuse another's results
+        self.cache = mines.LRUCache()
+
+    def create_solver(self, spaces):
+        solver = mines.Solver(spaces, engine=self.engine)
+        solver.counter = self.counter
+        solver.cluster_probabilities_cache = self.cache
+        if self.processes:
+            # send every cluster to the workers, however small
+            solver.processes = self.processes
+            solver.min_process_cluster_size = 1
+        return solver
+
     def test_solve(self):
         for desc, information_descs, known_mine_spaces, known_clear_spaces, expected_possibilities, expected_probabilities in self.layouts:
             informations = []
@@ -69,7 +95,7 @@ class SolverTests(unittest.TestCase):
             known_spaces = set(known_mine_spaces)
             known_spaces.update(known_clear_spaces)
 
-            solver = mines.Solver(spaces)
+            solver = self.create_solver(spaces)
 
             try:
                 for information in informations:
@@ -109,7 +135,7 @@ class SolverTests(unittest.TestCase):
 
             expected_probabilities = dict(expected_probabilities)
 
-            solver = mines.Solver(spaces)
+            solver = self.create_solver(spaces)
 
             try:
                 for information in informations:
@@ -140,6 +166,88 @@ class SolverTests(unittest.TestCase):
                         continue
                     self.assertEqual(probabilities[space], expected_probability, '%s: %s' % (desc, space))
 
+    def test_float_probabilities(self):
+        for desc, information_descs, known_mine_spaces, known_clear_spaces, expected_possibilities, expected_probabilities in self.layouts:
+            if expected_possibilities == 0:
+                continue
+
+            spaces = set()
+            for information in information_descs:
+                spaces.update(information[1:])
+            solver = self.create_solver(spaces)
+            for information in information_descs:
+                solver.add_information(mines.Information(frozenset(information[1:]), information[0]))
+
+            probabilities, num_possibilities = solver.get_probabilities()
+            float_probabilities, log_possibilities = solver.get_float_probabilities()
+
+            self.assertAlmostEqual(log_possibilities, math.log(num_possibilities), 9, desc)
+            self.assertEqual(set(float_probabilities), set(probabilities), desc)
+            for space in probabilities:
+                self.assertAlmostEqual(float_probabilities[space], float(probabilities[space]) / num_possibilities, 9,
+                    '%s: %s' % (desc, space))
+
+        # counts too large for a float
+        spaces = range(2000)
+        solver = self.create_solver(spaces)
+        solver.add_information(mines.Information(frozenset(spaces[:1000]), 500))
+        solver.add_information(mines.Information(frozenset(spaces[1000:]), 300))
+        probabilities, log_possibilities = solver.get_float_probabilities()
+        self.assertAlmostEqual(probabilities[0], 0.5)
+        self.assertAlmostEqual(probabilities[1500], 0.3)
+        self.assertAlmostEqual(log_possibilities, math.log(mines.choose(1000, 500)) + math.log(mines.choose(1000, 300)))
+
+        # an odd cycle that only counting finds has no arrangements
+        solver = self.create_solver(range(3))
+        solver.add_information(mines.Information(frozenset((0, 1)), 1))
+        solver.add_information(mines.Information(frozenset((1, 2)), 1))
+        solver.add_information(mines.Information(frozenset((2, 0)), 1))
+        self.assertRaises(mines.UnsolveableException, solver.get_float_probabilities)
+
+    def test_space_probabilities(self):
+        for desc, information_descs, known_mine_spaces, known_clear_spaces, expected_possibilities, expected_probabilities in self.layouts:
+            if expected_possibilities == 0:
+                continue
+
+            spaces = set()
+            for information in information_descs:
+                spaces.update(information[1:])
+            solver = self.create_solver(spaces)
+            for information in information_descs:
+                solver.add_information(mines.Information(frozenset(information[1:]), information[0]))
+
+            probabilities, num_possibilities = solver.get_float_probabilities()
+            for space in spaces:
+                result = solver.get_space_probabilities([space])
+                if space in solver.solved_spaces:
+                    self.assertEqual(result, {space: solver.solved_spaces[space]}, '%s: %s' % (desc, space))
+                else:
+                    self.assertAlmostEqual(result[space], probabilities[space], 9, '%s: %s' % (desc, space))
+
+        solver = self.create_solver(range(6))
+        solver.add_information(mines.Information(frozenset((0, 1, 2)), 1))
+        solver.add_information(mines.Information(frozenset((3, 4)), 1))
+        self.assertEqual(solver.get_space_probabilities((0, 3, 5)), {0: 1.0 / 3, 3: 0.5})
+        solver.add_information(mines.Information(frozenset((2, 3)), 2))
+        self.assertEqual(solver.get_space_probabilities((0, 3, 4)), {0: 0.0, 3: 1.0, 4: 0.0})
+
+        # spaces that only the total number of mines covers, in an information
+        # too large for the bitset engine to index by space
+        solver = self.create_solver((x, y) for y in xrange(12) for x in xrange(12))
+        solver.add_grid(12, 12, '1' + '-' * 143, 20)
+        probabilities, log_total = solver.get_float_probabilities()
+        for space in ((1, 0), (11, 11)):
+            self.assertAlmostEqual(solver.get_space_probabilities([space])[space], probabilities[space], 9)
+
+        # an odd cycle has no arrangements, but the other cluster still does
+        solver = self.create_solver(range(5))
+        solver.add_information(mines.Information(frozenset((0, 1)), 1))
+        solver.add_information(mines.Information(frozenset((1, 2)), 1))
+        solver.add_information(mines.Information(frozenset((2, 0)), 1))
+        solver.add_information(mines.Information(frozenset((3, 4)), 1))
+        self.assertEqual(solver.get_space_probabilities([3]), {3: 0.5})
+        self.assertRaises(mines.UnsolveableException, solver.get_space_probabilities, [0])
+
     def test_possibility(self):
         desc = None
 
@@ -153,7 +261,7 @@ class SolverTests(unittest.TestCase):
 
                 expected_probabilities = dict(expected_probabilities)
 
-                solver = mines.Solver(spaces)
+                solver = self.create_solver(spaces)
 
                 try:
                     for information in informations:
@@ -173,6 +281,664 @@ class SolverTests(unittest.TestCase):
             print("Failing test: %s" % desc)
             raise
 
+    def test_possibilities(self):
+        rand = random.Random(0)
+        for desc in ('2/4', 'square', '3/3', 'total', 'total2'):
+            for layout in self.layouts:
+                if layout[0] == desc:
+                    break
+            information_descs = layout[1]
+            spaces = set()
+            for information in information_descs:
+                spaces.update(information[1:])
+            solver = self.create_solver(spaces)
+            for information in information_descs:
+                solver.add_information(mines.Information(frozenset(information[1:]), information[0]))
+
+            # every arrangement should be drawn about equally often
+            arrangements = collections.defaultdict(int)
+            for possibility in solver.get_possibilities(100 * layout[4], rand):
+                for information in information_descs:
+                    self.assertEqual(sum(possibility[space] for space in information[1:]), information[0], desc)
+                arrangements[tuple(sorted(possibility.iteritems()))] += 1
+            self.assertEqual(len(arrangements), layout[4], desc)
+            for arrangement, count in arrangements.iteritems():
+                self.assertTrue(50 <= count <= 150, '%s: %s drawn %i times' % (desc, arrangement, count))
+
+        # the same as the 'total' layout, with the total given to get_possibilities
+        solver = self.create_solver(range(7))
+        solver.add_information(mines.Information(frozenset((0, 1)), 1))
+        solver.add_information(mines.Information(frozenset((2, 3)), 1))
+        solver.add_known_value(6, 1)
+        arrangements = collections.defaultdict(int)
+        for possibility in solver.get_possibilities(800, rand, total=4):
+            self.assertEqual(possibility[6], 1)
+            self.assertEqual(possibility[0] + possibility[1], 1)
+            self.assertEqual(possibility[2] + possibility[3], 1)
+            self.assertEqual(sum(possibility.itervalues()), 4)
+            arrangements[tuple(sorted(possibility.iteritems()))] += 1
+        self.assertEqual(len(arrangements), 8)
+        for arrangement, count in arrangements.iteritems():
+            self.assertTrue(50 <= count <= 150, 'total: %s drawn %i times' % (arrangement, count))
+        self.assertRaises(mines.UnsolveableException, solver.get_possibilities, 1, rand, 7)
+
+        # the total given both ways, with most spaces covered only by an
+        # information too large for the bitset engine to index by space
+        solver = self.create_solver((x, y) for y in xrange(12) for x in xrange(12))
+        solver.add_grid(12, 12, '1' + '-' * 143, 20)
+        for possibility in solver.get_possibilities(3, rand, total=20):
+            self.assertEqual(sum(possibility.itervalues()), 20)
+            self.assertEqual(possibility[1, 0] + possibility[0, 1] + possibility[1, 1], 1)
+
+    def test_estimate_probabilities(self):
+        rand = random.Random(0)
+        for desc in ('2/4', '3/3', 'difference', 'total', 'total2'):
+            for layout in self.layouts:
+                if layout[0] == desc:
+                    break
+            information_descs = layout[1]
+            spaces = set()
+            for information in information_descs:
+                spaces.update(information[1:])
+            solver = self.create_solver(spaces)
+            for information in information_descs:
+                solver.add_information(mines.Information(frozenset(information[1:]), information[0]))
+
+            probabilities, total = solver.get_float_probabilities()
+            estimate = solver.estimate_probabilities(time_limit=60, max_steps=1000, rand=rand)
+            self.assertEqual(set(estimate.probabilities), set(probabilities), desc)
+            self.assertTrue(estimate.r_hat < 1.2, '%s: r_hat is %s' % (desc, estimate.r_hat))
+            for space in probabilities:
+                self.assertTrue(abs(estimate.probabilities[space] - probabilities[space]) < 0.1,
+                    '%s: %s estimated %s, expected %s' % (desc, space, estimate.probabilities[space], probabilities[space]))
+                self.assertTrue(estimate.errors[space] < 0.1, desc)
+
+            if estimate.steps == 0:
+                continue
+            # no time to start the chains: only the exact spaces are returned
+            estimate = solver.estimate_probabilities(time_limit=0, rand=rand)
+            self.assertEqual(estimate.steps, 0, desc)
+            self.assertEqual(estimate.r_hat, float('inf'), desc)
+            self.assertTrue(len(estimate.probabilities) < len(probabilities), desc)
+            for space in estimate.probabilities:
+                self.assertEqual(estimate.errors[space], 0.0, desc)
+
+    def test_copy(self):
+        solver = self.create_solver(range(6))
+        solver.add_information(mines.Information(frozenset((0, 1, 2)), 1))
+        solver.add_information(mines.Information(frozenset((2, 3, 4)), 1))
+        solver.solve()
+
+        new_solver = solver.copy()
+        new_solver.add_information(mines.Information(frozenset((4, 5)), 1))
+        new_solver.add_known_value(2, 0)
+        new_solver.solve()
+        self.assertEqual(solver.get_probabilities(), ({0: 2, 1: 2, 2: 1, 3: 2, 4: 2}, 5))
+        self.assertEqual(new_solver.get_probabilities(), ({0: 2, 1: 2, 3: 2, 4: 2, 5: 2}, 4))
+
+        # changing the original afterwards mustn't change the copy either
+        solver.add_known_value(0, 1)
+        solver.solve()
+        self.assertEqual(solver.get_probabilities(), ({3: 1, 4: 1}, 2))
+        self.assertEqual(new_solver.get_probabilities(), ({0: 2, 1: 2, 3: 2, 4: 2, 5: 2}, 4))
+
+    def test_rollback(self):
+        solver = self.create_solver(range(5))
+        solver.add_information(mines.Information(frozenset((0, 1, 2)), 1))
+        solver.add_information(mines.Information(frozenset((2, 3, 4)), 1))
+        solver.solve()
+        expected = solver.get_probabilities()
+
+        outer_mark = solver.checkpoint()
+        solver.add_known_value(2, 0)
+        solver.solve()
+        inner_mark = solver.checkpoint()
+        solver.add_information(mines.Information(frozenset((0, 1)), 0))
+        self.assertRaises(mines.UnsolveableException, solver.solve)
+        solver.rollback(inner_mark)
+        self.assertEqual(solver.get_probabilities(), ({0: 2, 1: 2, 3: 2, 4: 2}, 4))
+        solver.rollback(outer_mark)
+        self.assertEqual(solver.get_probabilities(), expected)
+        self.assertEqual(solver.solved_spaces, {})
+
+    def test_informations_for_space(self):
+        solver = self.create_solver(range(100))
+        small = mines.Information(frozenset((0, 1, 2)), 1)
+        total = mines.Information(frozenset(range(100)), 10)
+        solver.add_information(small)
+        solver.add_information(total)
+        solver.solve()
+        rest = mines.Information(frozenset(range(3, 100)), 9)
+        self.assertEqual(solver.information, set([small, rest]))
+        self.assertEqual(list(solver.get_informations_for_space(1)), [small])
+        self.assertEqual(list(solver.get_informations_for_space(50)), [rest])
+
+        # the same views are returned until the solver changes
+        self.assertTrue(solver.solved_spaces is solver.solved_spaces)
+        self.assertTrue(solver.information is solver.information)
+        mark = solver.checkpoint()
+        solver.add_known_value(0, 1)
+        solver.solve()
+        self.assertEqual(solver.solved_spaces, {0: 1, 1: 0, 2: 0})
+        self.assertEqual(solver.information, set([mines.Information(frozenset(range(3, 100)), 9)]))
+        solver.rollback(mark)
+        self.assertEqual(solver.solved_spaces, {})
+        self.assertEqual(solver.information, set([small, rest]))
+
+    def test_try_information(self):
+        solver = self.create_solver(range(5))
+        solver.add_information(mines.Information(frozenset((0, 1, 2)), 1))
+        solver.add_information(mines.Information(frozenset((2, 3, 4)), 1))
+        solver.solve()
+        expected = solver.get_probabilities()
+
+        changes = solver.try_information(mines.Information(frozenset((0, 1)), 0))
+        self.assertEqual(changes.solved, {0: 0, 1: 0, 2: 1, 3: 0, 4: 0})
+        self.assertEqual(changes.removed, set([mines.Information(frozenset((0, 1, 2)), 1),
+            mines.Information(frozenset((2, 3, 4)), 1)]))
+        self.assertEqual(changes.added, set())
+        self.assertEqual(solver.get_probabilities(), expected)
+        self.assertEqual(solver.solved_spaces, {})
+
+        changes = solver.try_information(mines.Information(frozenset((0, 1, 2)), 1))
+        self.assertFalse(any(changes))
+
+        self.assertRaises(mines.UnsolveableException, solver.try_information,
+            mines.Information(frozenset((0, 1, 2)), 2))
+        self.assertEqual(solver.get_probabilities(), expected)
+
+        mark = solver.checkpoint()
+        solver.add_known_value(3, 1)
+        solver.solve()
+        self.assertEqual(solver.get_changes(mark).solved, {2: 0, 3: 1, 4: 0})
+        solver.release(mark)
+        self.assertEqual(solver.get_probabilities(), ({0: 1, 1: 1}, 2))
+
+    def test_rule_counts(self):
+        solver = self.create_solver(range(3))
+        solver.add_information(mines.Information(frozenset((0, 1, 2)), 1))
+        solver.add_information(mines.Information(frozenset((0, 1)), 1))
+        solver.solve()
+        self.assertEqual(solver.solved_spaces, {2: 0})
+        self.assertEqual(solver.rule_counts, dict(known=0, solved=0, subset=1, superset=0, overlap=0))
+
+    def test_add_grid(self):
+        cells = ('--1-'
+                 'm-2-'
+                 '-c1-')
+        spaces = [(x, y) for y in range(3) for x in range(4)]
+
+        solver = self.create_solver(spaces)
+        solver.add_grid(4, 3, cells, 3)
+
+        expected_solver = self.create_solver(spaces)
+        for (x, y), cell in zip(spaces, cells):
+            if cell == 'm':
+                expected_solver.add_known_value((x, y), 1)
+            elif cell != '-':
+                expected_solver.add_known_value((x, y), 0)
+            if cell.isdigit():
+                expected_solver.add_information(mines.Information(frozenset((xs, ys) for (xs, ys) in spaces
+                    if abs(xs - x) <= 1 and abs(ys - y) <= 1), int(cell)))
+        expected_solver.add_information(mines.Information(frozenset(spaces), 3))
+
+        solver.solve()
+        expected_solver.solve()
+        self.assertEqual(solver.solved_spaces, expected_solver.solved_spaces)
+        self.assertEqual(solver.get_probabilities(), expected_solver.get_probabilities())
+
+        self.assertRaises(ValueError, solver.add_grid, 4, 3, cells[1:])
+        self.assertRaises(ValueError, solver.add_grid, 4, 3, cells.replace('c', '?'))
+
+        # numbers that contradict each other are found by solve, with or
+        # without NumPy
+        for numpy_grid in (False, True):
+            solver = self.create_solver((x, 0) for x in range(3))
+            solver.numpy_grid = numpy_grid
+            solver.add_grid(3, 1, '0-1')
+            self.assertRaises(mines.UnsolveableException, solver.solve)
+
+    @unittest.skipIf(mines.numpy is None, "NumPy is not installed")
+    def test_add_grid_numpy(self):
+        rand = random.Random(3)
+        width, height = 12, 8
+        spaces = [(x, y) for y in range(height) for x in range(width)]
+        mine_spaces = frozenset(rand.sample(spaces, 20))
+        cells = ''.join('m' if (x, y) in mine_spaces and rand.random() < 0.2 else
+            '-' if (x, y) in mine_spaces or rand.random() < 0.4 else
+            str(sum(1 for xs in range(x-1, x+2) for ys in range(y-1, y+2) if (xs, ys) in mine_spaces))
+            for (x, y) in spaces)
+
+        results = []
+        for numpy_grid in (False, True):
+            solver = self.create_solver(spaces)
+            solver.numpy_grid = numpy_grid
+            solver.add_grid(width, height, cells, 20)
+            solver.solve()
+            results.append((solver.solved_spaces, solver.get_probabilities()))
+        self.assertEqual(results[0], results[1])
+
+        solver = self.create_solver(spaces)
+        self.assertRaises(mines.UnsolveableException, solver.add_grid, 3, 1, '-0m')
+        self.assertRaises(ValueError, solver.add_grid, 4, 3, '--1-m-2--?1-')
+
+class BitsetSolverTests(SolverTests):
+    engine = 'bitset'
+
+class DPSolverTests(SolverTests):
+    counter = 'dp'
+
+class ProcessSolverTests(SolverTests):
+    processes = 2
+
+class BatchTests(unittest.TestCase):
+    def test_batch(self):
+        infile = StringIO.StringIO('\n'.join((
+            '{"id": 1, "width": 5, "height": 5, "total": 10, "cells": "02m--02m--12-------------"}',
+            '{"id": 2, "width": 5, "height": 5, "total": 10, "cells": "02m--02m--11-------------"}',
+            '',
+            '{"id": 3, "width": 5, "height": 5, "cells": "02m--"}',
+            'not json',
+            '{"id": 4, "width": 2, "height": 1, "cells": "1-"}',
+        )))
+        outfile = StringIO.StringIO()
+        mines.batch_main(infile, outfile)
+        results = [json.loads(line) for line in outfile.getvalue().splitlines()]
+
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[0]['id'], 1)
+        self.assertEqual(results[0]['solved'], '001--001--000----0-------')
+        self.assertEqual(results[0]['arrangements'], 3432)
+        self.assertEqual(len(results[0]['probabilities']), 15)
+        self.assertEqual(results[0]['probabilities'][6], [0, 3, 0.5])
+        self.assertEqual(results[1], {'id': 2, 'error': 'unsolveable'})
+        self.assertEqual(results[2]['id'], 3)
+        self.assertTrue(results[2]['error'].startswith('invalid record'))
+        self.assertEqual(results[3]['id'], None)
+        self.assertTrue(results[3]['error'].startswith('invalid record'))
+        self.assertEqual(results[4], {'id': 4, 'solved': '01', 'arrangements': 1, 'probabilities': []})
+
+    def test_batch_large_count(self):
+        # more arrangements than a float can hold, followed by another board
+        infile = StringIO.StringIO('\n'.join((
+            json.dumps({'id': 1, 'width': 40, 'height': 40, 'total': 300, 'cells': '1' + '-' * 1599}),
+            '{"id": 2, "width": 2, "height": 1, "cells": "1-"}',
+        )))
+        outfile = StringIO.StringIO()
+        mines.batch_main(infile, outfile)
+        results = [json.loads(line) for line in outfile.getvalue().splitlines()]
+
+        self.assertEqual(len(results), 2)
+        self.assertTrue(results[0]['arrangements'] > 2 ** 1024)
+        self.assertEqual(len(results[0]['probabilities']), 1599)
+        self.assertAlmostEqual(results[0]['probabilities'][0][2], 1.0 / 3)
+        self.assertEqual(results[1]['solved'], '01')
+
+    def test_picmagen_batch(self):
+        outputs = []
+        for processes in (0, 2):
+            outfile = StringIO.StringIO()
+            stats = mines.picmagen_batch(5, 5, 4, outfile, seed=1, processes=processes)
+            self.assertEqual(stats['puzzles'], 4)
+            self.assertEqual(stats['generated'], 4 + stats['unsolveable'] + stats['rejected'])
+            outputs.append(outfile.getvalue())
+        # the same seed gives the same puzzles, however many processes make them
+        self.assertEqual(outputs[0], outputs[1])
+
+        records = [json.loads(line) for line in outputs[0].splitlines()]
+        self.assertEqual(len(records), 4)
+        for record in records:
+            minemap = mines.RectMap(5, 5)
+            puzzle = mines.PicmaPuzzle(minemap)
+            for i, (clue, value) in enumerate(zip(record['clues'], record['solution'])):
+                y, x = divmod(i, 5)
+                minemap[x, y] = int(value)
+                if clue != '-':
+                    puzzle.known_spaces[x, y] = int(clue)
+            self.assertEqual(len(puzzle.known_spaces), record['num_clues'])
+            for space, value in puzzle.known_spaces.iteritems():
+                self.assertEqual(puzzle.get_clue(space).count, value)
+            solver = puzzle.create_solver()
+            solver.solve()
+            self.assertEqual(len(solver.solved_spaces), 25)
+
+        # only puzzles in the difficulty range are kept
+        outfile = StringIO.StringIO()
+        mines.picmagen_batch(5, 5, 2, outfile, seed=1, min_difficulty=1)
+        for line in outfile.getvalue().splitlines():
+            self.assertTrue(json.loads(line)['difficulty'] >= 1)
+
+        # a difficulty range that nothing is in gives up instead of running
+        # forever
+        outfile = StringIO.StringIO()
+        report = StringIO.StringIO()
+        stats = mines.picmagen_batch(5, 5, 2, outfile, seed=1, max_difficulty=-1, report=report,
+            max_empty_rounds=2)
+        self.assertTrue(stats['gave_up'])
+        self.assertEqual(stats['puzzles'], 0)
+        self.assertEqual(stats['generated'], 8)
+        self.assertEqual(outfile.getvalue(), '')
+        self.assertTrue('gave up' in report.getvalue())
+        self.assertFalse(mines.picmagen_batch(5, 5, 2, StringIO.StringIO(), seed=1)['gave_up'])
+
+class BoardParserTests(unittest.TestCase):
+    def test_read_cells(self):
+        reader = boardparser.BoardReader(StringIO.StringIO('02m-\r\n1c--\n\n--\t-m 0123\n'), boardparser.MINES_CELLS)
+        self.assertEqual(reader.read_board(4, 2), '02m-1c--')
+        self.assertEqual(reader.read_board(2, 2), '---m')
+        self.assertEqual(reader.read_cells(3), '012')
+        self.assertRaises(EOFError, reader.read_cells, 2)
+
+        reader = boardparser.BoardReader(StringIO.StringIO('01\n2m\n'), boardparser.PICMA_CELLS)
+        self.assertRaises(ValueError, reader.read_cells, 4)
+
+    def test_grid_constraints(self):
+        constraints = list(boardparser.get_grid_constraints(3, 2, '1-m-2-'))
+        self.assertEqual(constraints, [
+            (frozenset([(1, 0), (0, 1), (1, 1)]), 1),
+            (frozenset([(0, 0), (2, 0), (0, 1), (2, 1), (1, 0)]), 2),
+        ])
+        constraints = list(boardparser.get_grid_constraints(2, 1, '3-', include_center=True))
+        self.assertEqual(constraints, [(frozenset([(0, 0), (1, 0)]), 3)])
+
+class GeometryTests(unittest.TestCase):
+    def test_rect(self):
+        rect = geometry.rect(3, 2)
+        self.assertTrue(rect is geometry.rect(3, 2))
+        self.assertEqual(rect.spaces, ((0, 0), (1, 0), (2, 0), (0, 1), (1, 1), (2, 1)))
+        self.assertEqual(rect.get_adjacent_spaces((0, 0)), frozenset([(1, 0), (0, 1), (1, 1)]))
+        self.assertEqual(rect.get_neighbourhood((0, 0)), frozenset([(0, 0), (1, 0), (0, 1), (1, 1)]))
+        self.assertTrue(rect.get_adjacent_spaces((1, 1)) is rect.get_adjacent_spaces((1, 1)))
+        self.assertEqual(rect.get_adjacent_indices()[0], (1, 3, 4))
+
+    def test_lazy(self):
+        # only the spaces that are asked about are worked out
+        rect = geometry.rect(2000, 2000)
+        self.assertEqual(len(rect), 4000000)
+        self.assertEqual(rect.get_adjacent_spaces((0, 1999)), frozenset([(1, 1999), (0, 1998), (1, 1998)]))
+        self.assertEqual(len(rect.neighbourhoods), 1)
+        self.assertTrue((1999, 1999) in rect)
+        for space in ((2000, 0), (-1, 0), (0,), (0.5, 0), 'ab'):
+            self.assertFalse(space in rect, space)
+            self.assertRaises(KeyError, rect.get_neighbourhood, space)
+
+    def test_shapes(self):
+        # (geometry, number of spaces, {number of adjacent spaces: number of spaces})
+        shapes = (
+            (geometry.torus(4, 3), 12, {8: 12}),
+            (geometry.grid((3, 3, 3)), 27, {7: 8, 11: 12, 17: 6, 26: 1}),
+            (geometry.hexagonal(3, 3), 9, {2: 2, 3: 3, 4: 2, 5: 1, 6: 1}),
+            (geometry.cube(3), 54, {7: 24, 8: 30}),
+        )
+        for shape, num_spaces, adjacent_counts in shapes:
+            self.assertEqual(len(shape), num_spaces)
+            counts = collections.Counter(len(shape.get_adjacent_spaces(space)) for space in shape)
+            self.assertEqual(dict(counts), adjacent_counts)
+            for space in shape:
+                for adjacent in shape.get_adjacent_spaces(space):
+                    self.assertTrue(space in shape.get_adjacent_spaces(adjacent))
+
+    def test_add_board(self):
+        rect = geometry.rect(3, 3)
+        solver = mines.Solver(rect.spaces)
+        solver.add_board({(1, 1): 0}, {(1, 1): 2}, rect.get_adjacent_spaces)
+        (information,) = solver.pending_informations
+        self.assertTrue(information.spaces is rect.get_adjacent_spaces((1, 1)))
+
+class MineMapTests(unittest.TestCase):
+    def test_randomize(self):
+        rand = random.Random(0)
+        minemap = mines.RectMap(7, 5)
+        for count in (0, 1, 17, 35):
+            minemap.randomize_count(rand, count)
+            self.assertEqual(sum(minemap.values), count)
+        for p in (0.5, 0.2):
+            minemap.randomize_p(rand, p)
+            self.assertEqual(len(minemap.values), 35)
+            self.assertTrue(set(minemap.values) <= set((0, 1)))
+
+    def test_neighbour_sums(self):
+        rand = random.Random(0)
+        minemap = mines.RectMap(6, 4)
+        minemap.randomize_p(rand)
+        expected = bytearray(sum(minemap[s] for s in minemap.get_bordering_spaces((x, y)))
+            for y in range(4) for x in range(6))
+        numpy = mines.numpy
+        try:
+            mines.numpy = None
+            self.assertEqual(minemap.get_neighbour_sums(), expected)
+        finally:
+            mines.numpy = numpy
+        self.assertEqual(minemap.get_neighbour_sums(), expected)
+
+    @unittest.skipIf(mines.numpy is None, "NumPy is not installed")
+    def test_get_array(self):
+        minemap = mines.RectMap(3, 2)
+        array = minemap.get_array()
+        minemap[2, 1] = 1
+        self.assertEqual(array[1, 2], 1)
+        minemap.randomize_count(random.Random(0), 4)
+        self.assertEqual(array.sum(), 4)
+
+    def test_get_grid(self):
+        minemap = mines.RectMap(4, 3)
+        minemap[1, 0] = 1
+        minemap[3, 2] = 1
+        self.assertEqual(minemap.get_grid([(0, 0), (1, 0), (2, 1)]), '1m----2-----')
+
+        rand = random.Random(0)
+        minemap = mines.RectMap(8, 8)
+        minemap.randomize_count(rand, 10)
+        solver = mines.Solver(minemap.spaces)
+        solver.add_grid(8, 8, minemap.get_grid(rand.sample(sorted(minemap.spaces), 30)), 10)
+        solver.solve()
+        for space, value in solver.solved_spaces.iteritems():
+            self.assertEqual(value, minemap[space])
+
+class PicmaPuzzleTests(unittest.TestCase):
+    def test_make_solveable(self):
+        results = []
+        for processes in (0, 2):
+            rand = random.Random(0)
+            minemap = mines.RectMap(6, 6)
+            minemap.randomize_p(rand)
+            puzzle = mines.PicmaPuzzle(minemap)
+            puzzle.processes = processes
+            puzzle.make_solveable(rand)
+            solver = puzzle.create_solver()
+            solver.solve()
+            self.assertEqual(solver.solved_spaces, dict((space, minemap[space]) for space in minemap.spaces))
+            for space, value in puzzle.known_spaces.iteritems():
+                self.assertEqual(puzzle.get_clue(space).count, value)
+            results.append(puzzle.known_spaces)
+        # trying several clues at once gives the same puzzle as one at a time
+        self.assertEqual(results[0], results[1])
+
+    def test_trim(self):
+        rand = random.Random(0)
+        minemap = mines.RectMap(6, 6)
+        minemap.randomize_p(rand)
+        puzzle = mines.PicmaPuzzle(minemap)
+        puzzle.make_solveable(rand)
+        known_spaces = puzzle.known_spaces.items()
+        puzzle.trim(rand)
+
+        # the same clues are kept as removing each and solving again would keep
+        expected = dict(known_spaces)
+        for space, value in known_spaces:
+            del expected[space]
+            other = mines.PicmaPuzzle(minemap)
+            other.known_spaces = expected
+            solver = other.create_solver()
+            solver.solve()
+            if len(solver.solved_spaces) != len(minemap.spaces):
+                expected[space] = value
+        self.assertEqual(puzzle.known_spaces, expected)
+        self.assertTrue(len(puzzle.known_spaces) < len(known_spaces))
+
+class FailingSolver(mines.Solver):
+    def try_information(self, information):
+        if information.count == 2:
+            raise ValueError("failed")
+        return mines.Solver.try_information(self, information)
+
+class WorkerSolversTests(unittest.TestCase):
+    def test_errors(self):
+        solver = FailingSolver(range(4))
+        solver.add_information(mines.Information(frozenset((0, 1, 2, 3)), 2))
+        informations = [mines.Information(frozenset((0, 1)), count) for count in (0, 1, 2)]
+
+        # an exception in a worker is raised in the parent
+        workers = mines.WorkerSolvers(solver, 2)
+        try:
+            self.assertEqual(len(workers.try_informations(informations[:2])), 2)
+            self.assertRaises(ValueError, workers.try_informations, informations)
+        finally:
+            workers.close()
+
+        # so is one while adding informations, at the next call
+        workers = mines.WorkerSolvers(solver, 1)
+        try:
+            workers.add_informations([mines.Information(frozenset((0, 1)), 3)])
+            self.assertRaises(mines.UnsolveableException, workers.try_informations, informations[:1])
+        finally:
+            workers.close()
+
+        # a worker that exits without replying doesn't leave the parent waiting
+        workers = mines.WorkerSolvers(solver, 1)
+        try:
+            workers.workers[0].terminate()
+            workers.workers[0].join()
+            self.assertRaises((RuntimeError, IOError), workers.try_informations, informations[:1])
+        finally:
+            workers.close()
+
+class LRUCacheTests(unittest.TestCase):
+    def test_max_entries(self):
+        cache = mines.LRUCache(max_entries=2)
+        cache.set(1, 'a')
+        cache.set(2, 'b')
+        self.assertEqual(cache.get(1), 'a')
+        cache.set(3, 'c')
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual(cache.get(1), 'a')
+        self.assertEqual(cache.get(3), 'c')
+        self.assertEqual(cache.stats(), dict(entries=2, bytes=0, hits=3, misses=1, evictions=1))
+
+    def test_max_bytes(self):
+        cache = mines.LRUCache(max_bytes=10, sizeof=len)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'xxxx')
+        self.assertEqual(cache.bytes, 10)
+        cache.set('c', 'xxxx')
+        self.assertEqual(cache.bytes, 10)
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_resize(self):
+        cache = mines.LRUCache(max_entries=3, max_bytes=10, sizeof=len)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'xxxx')
+        cache.resize(max_entries=5)
+        self.assertEqual((cache.max_entries, cache.max_bytes), (5, 10))
+        cache.set('c', 'xxxx')
+        self.assertFalse('a' in cache)
+        cache.resize(max_bytes=None)
+        self.assertEqual((cache.max_entries, cache.max_bytes), (5, None))
+        cache.resize(max_entries=1)
+        self.assertEqual(len(cache), 1)
+
+    def test_snapshot_and_clear(self):
+        cache = mines.LRUCache()
+        cache.add('a')
+        snapshot = cache.snapshot()
+        cache.clear()
+        self.assertFalse('a' in cache)
+        self.assertTrue('a' in snapshot)
+        self.assertEqual(cache.stats(), dict(entries=0, bytes=0, hits=0, misses=0, evictions=0))
+
+    def test_per_solver_cache(self):
+        cache = mines.LRUCache()
+        solver = mines.Solver(range(5))
+        solver.cluster_probabilities_cache = cache
+        solver.add_information(mines.Information(frozenset((0, 1, 2)), 1))
+        solver.add_information(mines.Information(frozenset((2, 3, 4)), 1))
+        solver.solve()
+        self.assertEqual(solver.copy().cluster_probabilities_cache, cache)
+        solver.get_probabilities()
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.misses, 1)
+        # the solver keeps the counts of an unchanged cluster itself
+        solver.get_probabilities()
+        self.assertEqual(cache.hits, 0)
+        solver = mines.Solver(range(5))
+        solver.cluster_probabilities_cache = cache
+        solver.add_information(mines.Information(frozenset((0, 1, 2)), 1))
+        solver.add_information(mines.Information(frozenset((2, 3, 4)), 1))
+        solver.get_probabilities()
+        self.assertEqual(cache.hits, 1)
+
+    def test_isomorphic_clusters(self):
+        cache = mines.LRUCache()
+        results = []
+        for spaces in ((0, 1, 2, 3, 4), (14, 13, 12, 11, 10), ('a', 'b', 'c', 'd', 'e')):
+            solver = mines.Solver(spaces)
+            solver.cluster_probabilities_cache = cache
+            solver.add_information(mines.Information(frozenset(spaces[0:3]), 1))
+            solver.add_information(mines.Information(frozenset(spaces[2:5]), 2))
+            probabilities, total = solver.get_probabilities()
+            results.append(([probabilities[space] for space in spaces], total))
+        self.assertEqual(results, [([1, 1, 2, 3, 3], 4)] * 3)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.hits, 2)
+
+def fibonacci(executor, n):
+    if n < 2:
+        return n
+    a = executor.add_task(fibonacci, args=(executor, n-1))
+    b = executor.add_task(fibonacci, args=(executor, n-2))
+    return a.get() + b.get()
+
+def fail():
+    raise mines.UnsolveableException()
+
+class ExecutorTests(unittest.TestCase):
+    def test_nested_tasks(self):
+        for number_of_threads in (0, 1, 3):
+            executor = mines.Executor(number_of_threads)
+            self.assertEqual(executor.add_task(fibonacci, args=(executor, 12)).get(), 144)
+            stats = executor.stats()
+            self.assertEqual(stats['queue_depth'], 0)
+            self.assertEqual(stats['added'], stats['finished'])
+            executor.shutdown()
+
+    def test_exception(self):
+        executor = mines.Executor(0)
+        future = executor.add_task(fail)
+        self.assertRaises(mines.UnsolveableException, future.get)
+
+    def test_cancel(self):
+        executor = mines.Executor(0)
+        futures = [executor.add_task(len, args=('x' * i,)) for i in range(3)]
+        self.assertEqual(futures[0].get(), 0)
+        self.assertTrue(futures[1].cancel())
+        self.assertRaises(mines.CancelledException, futures[1].get)
+        self.assertFalse(futures[0].cancel())
+        self.assertEqual(futures[2].get(), 2)
+        self.assertEqual(executor.stats()['cancelled'], 1)
+        # nothing keeps the futures once they're done
+        self.assertEqual([len(d) for d in executor.deques], [0])
+
+    def test_no_workers(self):
+        # with no worker threads, futures are only run by asking for them,
+        # and they have to leave the deques then
+        executor = mines.Executor(0)
+        futures = [executor.add_task(len, args=('x' * i,)) for i in range(5)]
+        self.assertEqual([future.get() for future in futures[::2]], [0, 2, 4])
+        self.assertEqual(len(executor.deques[0]), 2)
+        self.assertEqual([future.get() for future in futures], range(5))
+        self.assertEqual([len(d) for d in executor.deques], [0])
+
 def choose_n(rand, n, pool):
     pool = list(pool)
     result = []
@@ -183,7 +949,44 @@ def choose_n(rand, n, pool):
         pool.pop(-1)
     return result
 
+def get_clusters(informations):
+    # reference version of Solver.get_clusters, which tracks them incrementally
+    informations_unassigned = set(informations)
+    result = set()
+    while informations_unassigned:
+        cluster = set((informations_unassigned.pop(),))
+        spaces = set(next(iter(cluster)).spaces)
+        changed = True
+        while changed:
+            changed = False
+            for information in list(informations_unassigned):
+                if not spaces.isdisjoint(information.spaces):
+                    informations_unassigned.remove(information)
+                    cluster.add(information)
+                    spaces.update(information.spaces)
+                    changed = True
+        result.add(frozenset(cluster))
+    return result
+
 class RandomTests(unittest.TestCase):
+    engine = None
+    counter = 'split'
+    processes = 0
+
+    def setUp(self):
+        # a cache for each test, so that one counter can't reuse another's results
+        self.cache = mines.LRUCache()
+
+    def create_solver(self, spaces):
+        solver = mines.Solver(spaces, engine=self.engine)
+        solver.counter = self.counter
+        solver.cluster_probabilities_cache = self.cache
+        if self.processes:
+            # send every cluster to the workers, however small
+            solver.processes = self.processes
+            solver.min_process_cluster_size = 1
+        return solver
+
     def run_random_test(self, rand):
         num_spaces = rand.randint(1,15)
 
@@ -192,7 +995,7 @@ class RandomTests(unittest.TestCase):
         informations = []
 
         try:
-            solver = mines.Solver(range(num_spaces))
+            solver = self.create_solver(range(num_spaces))
 
             while len(solver.solved_spaces) != num_spaces:
                 solved_spaces = set(solver.solved_spaces)
@@ -224,6 +1027,8 @@ class RandomTests(unittest.TestCase):
 
                 self.assertEqual(prob_solved_spaces, len(solver.solved_spaces))
 
+                self.assertEqual(solver.get_clusters(), get_clusters(solver.information))
+
                 for spaces, total in informations:
                     expected_value = 0
                     for i in spaces:
@@ -247,7 +1052,7 @@ class RandomTests(unittest.TestCase):
         informations = []
 
         try:
-            solver = mines.Solver(range(num_spaces))
+            solver = self.create_solver(range(num_spaces))
 
             while len(solver.solved_spaces) != num_spaces:
                 solved_spaces = set(solver.solved_spaces)
@@ -319,6 +1124,15 @@ class RandomTests(unittest.TestCase):
     def test_random(self):
         self.run_random_tests(random.SystemRandom().randint(-sys.maxint-1, sys.maxint))
 
+class BitsetRandomTests(RandomTests):
+    engine = 'bitset'
+
+class DPRandomTests(RandomTests):
+    counter = 'dp'
+
+class ProcessRandomTests(RandomTests):
+    processes = 2
+
 if __name__ == '__main__':
     unittest.main()
 